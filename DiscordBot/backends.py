@@ -0,0 +1,135 @@
+# backends.py
+import os
+import numpy as np
+
+MAX_SEQ_LENGTH = 128 # From outputs/model_args.json
+BATCH_SIZE = 8
+
+
+class SimpleTransformersBackend:
+    '''
+    The original full-precision simpletransformers model, always padded to MAX_SEQ_LENGTH.
+    '''
+
+    def __init__(self, model_dir):
+        from simpletransformers.classification import ClassificationModel
+        self.model = ClassificationModel(model_type='roberta', model_name=model_dir, use_cuda=False)
+
+    def predict(self, texts):
+        return self.model.predict(texts)
+
+
+class BucketedBackend:
+    '''
+    Shared logic for the CPU backends: texts are tokenized once, sorted by length and run in batches
+    padded only to the longest text in the batch, so short chat messages don't pay for 128 tokens.
+    Subclasses implement forward(batch) returning a numpy array of logits.
+    '''
+
+    def __init__(self, model_dir, batch_size=BATCH_SIZE, max_seq_length=MAX_SEQ_LENGTH):
+        from transformers import AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.batch_size = batch_size
+        self.max_seq_length = max_seq_length
+
+    def predict(self, texts):
+        '''
+        Same contract as ClassificationModel.predict: returns (predictions, raw_outputs) in input order.
+        '''
+        encoded = self.tokenizer(list(texts), truncation=True, max_length=self.max_seq_length)
+        order = sorted(range(len(texts)), key=lambda i: len(encoded['input_ids'][i]))
+        raw_outputs = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            indices = order[start:start + self.batch_size]
+            features = [{key: encoded[key][i] for key in encoded.keys()} for i in indices]
+            batch = self.tokenizer.pad(features, padding='longest', return_tensors='np')
+            logits = self.forward(batch)
+            for i, row in zip(indices, logits):
+                raw_outputs[i] = row
+        raw_outputs = np.array(raw_outputs)
+        return np.argmax(raw_outputs, axis=1), raw_outputs
+
+    def forward(self, batch):
+        raise NotImplementedError
+
+
+class TorchBackend(BucketedBackend):
+    '''
+    The checkpoint as a plain full-precision PyTorch model.
+    '''
+
+    def __init__(self, model_dir, **kwargs):
+        super().__init__(model_dir, **kwargs)
+        import torch
+        from transformers import AutoModelForSequenceClassification
+        self.torch = torch
+        self.model = AutoModelForSequenceClassification.from_pretrained(model_dir)
+        self.model.eval()
+
+    def forward(self, batch):
+        with self.torch.no_grad():
+            inputs = {key: self.torch.from_numpy(value) for key, value in batch.items()}
+            return self.model(**inputs).logits.numpy()
+
+
+class QuantizedBackend(TorchBackend):
+    '''
+    PyTorch model with int8 dynamic quantization applied to its Linear layers.
+    '''
+
+    def __init__(self, model_dir, **kwargs):
+        super().__init__(model_dir, **kwargs)
+        self.model = self.torch.quantization.quantize_dynamic(self.model, {self.torch.nn.Linear}, dtype=self.torch.qint8)
+
+
+class OnnxBackend(BucketedBackend):
+    '''
+    ONNX Runtime session over the checkpoint, exported to model.onnx in the checkpoint folder the first time.
+    '''
+
+    def __init__(self, model_dir, onnx_path=None, threads=None, **kwargs):
+        super().__init__(model_dir, **kwargs)
+        import onnxruntime
+        self.onnx_path = onnx_path or os.path.join(model_dir, 'model.onnx')
+        if not os.path.isfile(self.onnx_path):
+            export_onnx(model_dir, self.onnx_path)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(self.onnx_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def forward(self, batch):
+        inputs = {name: batch[name].astype(np.int64) for name in self.input_names}
+        return self.session.run(None, inputs)[0]
+
+
+def export_onnx(model_dir, onnx_path):
+    '''
+    Exports the checkpoint to ONNX with dynamic batch and sequence axes.
+    '''
+    import torch
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    model = AutoModelForSequenceClassification.from_pretrained(model_dir)
+    model.eval()
+    dummy = tokenizer(['dummy input'], return_tensors='pt')
+    dynamic_axes = {'input_ids': {0: 'batch', 1: 'sequence'}, 'attention_mask': {0: 'batch', 1: 'sequence'}, 'logits': {0: 'batch'}}
+    torch.onnx.export(model, (dummy['input_ids'], dummy['attention_mask']), onnx_path,
+                      input_names=['input_ids', 'attention_mask'], output_names=['logits'],
+                      dynamic_axes=dynamic_axes, opset_version=14)
+
+
+BACKENDS = {
+    'simpletransformers': SimpleTransformersBackend,
+    'torch': TorchBackend,
+    'quantized': QuantizedBackend,
+    'onnx': OnnxBackend,
+}
+
+
+def load_backend(name, model_dir, **kwargs):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {name!r}, expected one of {', '.join(BACKENDS)}")
+    return BACKENDS[name](model_dir, **kwargs)
@@ -0,0 +1,69 @@
+# benchmark_backends.py
+'''
+Checks the CPU inference backends against the original simpletransformers model on en_dup.csv
+and compares their latency and throughput.
+
+    python benchmark_backends.py --rows 500 --backends quantized onnx
+'''
+import argparse
+import csv
+import time
+import numpy as np
+from backends import load_backend
+
+
+def load_texts(path, rows):
+    with open(path, newline='', encoding='utf-8') as f:
+        texts = [row['content'] for row in csv.DictReader(f) if row['content']]
+    return texts[:rows] if rows else texts
+
+
+def run(backend, texts, batch_size):
+    # Single-message latency, the way the bot sees traffic when chat is quiet
+    latencies = []
+    for text in texts[:50]:
+        start = time.perf_counter()
+        backend.predict([text])
+        latencies.append(time.perf_counter() - start)
+
+    # Batched throughput, the way the bot sees traffic during a burst
+    predictions, raw_outputs = [], []
+    start = time.perf_counter()
+    for i in range(0, len(texts), batch_size):
+        p, r = backend.predict(texts[i:i + batch_size])
+        predictions.extend(p)
+        raw_outputs.extend(r)
+    elapsed = time.perf_counter() - start
+    return np.array(predictions), np.array(raw_outputs), latencies, len(texts) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='checkpoint-3750-epoch-10')
+    parser.add_argument('--data', default='../en_dup.csv')
+    parser.add_argument('--rows', type=int, default=500, help='number of rows to use, 0 for all')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--backends', nargs='+', default=['quantized', 'onnx'])
+    args = parser.parse_args()
+
+    texts = load_texts(args.data, args.rows)
+    print(f'{len(texts)} messages from {args.data}\n')
+
+    results = {}
+    for name in ['simpletransformers'] + args.backends:
+        start = time.perf_counter()
+        backend = load_backend(name, args.model)
+        load_time = time.perf_counter() - start
+        results[name] = run(backend, texts, args.batch_size) + (load_time,)
+
+    baseline_predictions, baseline_outputs = results['simpletransformers'][:2]
+    print(f"{'backend':<20}{'load s':>8}{'p50 ms':>9}{'p95 ms':>9}{'msg/s':>9}{'agree':>9}{'max |dlogit|':>14}")
+    for name, (predictions, raw_outputs, latencies, throughput, load_time) in results.items():
+        p50, p95 = np.percentile(latencies, [50, 95]) * 1000
+        agreement = np.mean(predictions == baseline_predictions)
+        max_diff = np.max(np.abs(raw_outputs - baseline_outputs))
+        print(f'{name:<20}{load_time:>8.1f}{p50:>9.1f}{p95:>9.1f}{throughput:>9.1f}{agreement:>9.2%}{max_diff:>14.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# benchmark_inference_server.py
+'''
+Measures how aggregate throughput and latency of inference_server.py scale with its worker count.
+Several clients (standing in for separate bot processes) each keep a few requests in flight, with
+texts drawn from en_dup.csv. Memory is reported as PSS, which splits the pages the workers share
+copy-on-write between them, summed over the server and its workers.
+
+    python benchmark_inference_server.py --workers 1 2 4 8 --clients 4 --messages 2000
+'''
+import argparse
+import asyncio
+import csv
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from inference import InferenceClient
+
+
+def load_texts(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        return [row['content'] for row in csv.DictReader(f) if row['content']]
+
+
+def pss_mb(pid):
+    '''
+    Proportional set size of a process and its children, in MB (Linux only).
+    '''
+    pids = [pid]
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        pids.append(int(entry))
+            except (OSError, IndexError, ValueError):
+                continue
+    total = 0
+    for p in pids:
+        try:
+            with open(f'/proc/{p}/smaps_rollup') as f:
+                total += sum(int(line.split()[1]) for line in f if line.startswith('Pss:'))
+        except OSError:
+            continue
+    return total / 1024
+
+
+async def wait_for_server(path, process, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'inference server exited with code {process.returncode}')
+        try:
+            _, writer = await asyncio.open_unix_connection(path)
+            writer.close()
+            return
+        except (FileNotFoundError, ConnectionError):
+            await asyncio.sleep(0.5)
+    raise TimeoutError(f'inference server not listening on {path} after {timeout}s')
+
+
+async def drive(path, texts, clients, concurrency, messages):
+    connections = [InferenceClient(path, timeout=120) for _ in range(clients)]
+    latencies = []
+    remaining = iter(range(messages))
+
+    async def caller(client):
+        for _ in remaining:
+            start = time.perf_counter()
+            await client.predict(random.choice(texts))
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(caller(client) for client in connections for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    for client in connections:
+        await client.close()
+    return messages / elapsed, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--clients', type=int, default=4, help='client connections, one per simulated bot process')
+    parser.add_argument('--concurrency', type=int, default=8, help='requests each client keeps in flight')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--data', default='../en_dup.csv')
+    parser.add_argument('--server', default='inference_server.py', help='server script to launch')
+    parser.add_argument('--startup-timeout', type=float, default=300)
+    args, server_args = parser.parse_known_args() # Anything else (--model, --backend, --threads...) goes to the server
+
+    random.seed(0)
+    texts = load_texts(args.data)
+    print(f"{'workers':>8}{'msg/s':>10}{'speedup':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'PSS MB':>9}")
+    baseline = None
+    for workers in args.workers:
+        path = os.path.join(tempfile.mkdtemp(), 'inference.sock')
+        command = [sys.executable, args.server, '--socket', path, '--workers', str(workers)] + server_args
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+        try:
+            asyncio.run(wait_for_server(path, process, args.startup_timeout))
+            # A short warm-up pass so every worker has run a forward pass before we time anything
+            asyncio.run(drive(path, texts, args.clients, args.concurrency, workers * 16))
+            throughput, latencies = asyncio.run(drive(path, texts, args.clients, args.concurrency, args.messages))
+            memory = pss_mb(process.pid)
+        finally:
+            # SIGINT lets the server shut its worker pool down
+            process.send_signal(signal.SIGINT)
+            process.wait()
+        baseline = baseline or throughput
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+        print(f'{workers:>8}{throughput:>10.1f}{throughput / baseline:>8.2f}x{p50:>9.1f}{p95:>9.1f}{p99:>9.1f}{memory:>9.0f}')
+
+
+if __name__ == '__main__':
+    main()
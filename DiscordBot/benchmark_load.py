@@ -0,0 +1,538 @@
+# benchmark_load.py
+'''
+Replays a synthetic mix of Discord traffic through ModBot's event handlers and reports handler
+latency percentiles, throughput, and queue depths over time. Guilds, channels, messages and authors
+are stand-in objects, the Perspective API is a stub HTTP server on localhost, and the classifier is
+a stand-in with a fixed per-batch cost unless a real backend is asked for. Nothing talks to Discord.
+
+Channel posts are sampled from en_dup.csv. Other events are edits of recent posts, steps of DM
+reporting flows, and moderator replies to open reports. Each event is dispatched as its own task,
+like discord.py does, at Poisson arrival times.
+
+    python benchmark_load.py --rate 20 --duration 60 --save baseline.json
+    python benchmark_load.py --rate 20 --duration 60 --compare baseline.json
+    python benchmark_load.py --backend quantized  # the real classifier instead of the stand-in
+    python benchmark_load.py --inference-socket /tmp/modbot-inference.sock  # a shared inference_server.py
+'''
+import argparse
+import asyncio
+import csv
+import itertools
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import traceback
+from collections import defaultdict
+import numpy as np
+from aiohttp import web
+import bot
+from backends import load_backend, BACKENDS
+from duplicates import LABEL_CODES
+from normalize import normalize_text
+from perspective import PerspectiveClient
+
+GROUP_NUM = '25'
+EVENT_TYPES = ['post', 'edit', 'dm', 'mod']
+DEFAULT_MIX = 'post=0.75,edit=0.1,dm=0.1,mod=0.05'
+CHATTER = ['anyone watching the game tonight?', 'lol same', 'good morning everyone', 'has anyone tried the new cafe downtown',
+           'I got my booster today, arm is a bit sore', 'what time is the meeting?', 'thanks for sharing!', 'that is wild']
+ids = itertools.count(10 ** 12)
+
+
+class FakeUser:
+    def __init__(self, user_id, name):
+        self.id = user_id
+        self.name = name
+
+
+class FakeReference:
+    def __init__(self, message_id):
+        self.message_id = message_id
+
+
+class FakeMessage:
+    def __init__(self, content, author, channel, message_id=None, reference=None):
+        self.id = next(ids) if message_id is None else message_id
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.reference = reference
+
+    async def add_reaction(self, emoji):
+        await self.channel.api_call()
+        self.channel.reactions += 1
+
+
+class FakeChannel:
+    def __init__(self, name, guild, latency):
+        self.id = next(ids)
+        self.name = name
+        self.guild = guild
+        self.latency = latency # Seconds each simulated Discord API call takes
+        self.messages = {} # Everything posted in the channel, so fetch_message always finds it
+        self.sent = []
+        self.reactions = 0
+        self.bot_user = None
+
+    async def api_call(self):
+        await asyncio.sleep(self.latency)
+
+    async def send(self, content):
+        await self.api_call()
+        message = FakeMessage(content, self.bot_user, self)
+        self.messages[message.id] = message
+        self.sent.append(message)
+        return message
+
+    async def fetch_message(self, message_id):
+        await self.api_call()
+        return self.messages[message_id]
+
+    def get_partial_message(self, message_id):
+        return self.messages.get(message_id) or FakeMessage('', self.bot_user, self, message_id)
+
+
+class FakeGuild:
+    def __init__(self, latency):
+        self.id = next(ids)
+        self.name = 'Benchmark Guild'
+        self.group = FakeChannel(f'group-{GROUP_NUM}', self, latency)
+        self.mod = FakeChannel(f'group-{GROUP_NUM}-mod', self, latency)
+        self.text_channels = [self.group, self.mod]
+
+    def get_channel(self, channel_id):
+        return next((c for c in self.text_channels if c.id == channel_id), None)
+
+
+class FakeModel:
+    '''
+    Stands in for the classifier: sleeps for a fixed cost per batch plus a cost per text (on the
+    inference thread, like a real forward pass) and answers with the text's en_dup.csv label, or T
+    for texts it hasn't seen.
+    '''
+
+    def __init__(self, labels, batch_seconds, item_seconds):
+        self.labels = labels # Map from normalized key to label code
+        self.batch_seconds = batch_seconds
+        self.item_seconds = item_seconds
+
+    def predict(self, texts):
+        time.sleep(self.batch_seconds + self.item_seconds * len(texts))
+        predictions = [self.labels.get(normalize_text(text).key, LABEL_CODES['T']) for text in texts]
+        return predictions, [[3.0 if code == p else 0.0 for code in range(3)] for p in predictions]
+
+
+class HarnessBot(bot.ModBot):
+    '''
+    ModBot connected to a fake guild instead of the Discord gateway. Only what discord.Client would
+    otherwise provide (user, guilds, get_guild) and the model loading are replaced.
+    '''
+
+    def __init__(self, guild, load, perspective_url):
+        super().__init__('benchmark')
+        self.perspective = PerspectiveClient('benchmark', url=perspective_url, retries=0)
+        self.fake_guild = guild
+        self.fake_user = FakeUser(next(ids), f'Group {GROUP_NUM} Bot')
+        self.load = load
+        self.edit_latencies = []
+        for channel in guild.text_channels:
+            channel.bot_user = self.fake_user
+
+    @property
+    def user(self):
+        return self.fake_user
+
+    @property
+    def guilds(self):
+        return [self.fake_guild]
+
+    def get_guild(self, guild_id):
+        return self.fake_guild if guild_id == self.fake_guild.id else None
+
+    def load_model(self):
+        return self.load()
+
+    async def evaluate_edit(self, message):
+        # Time the evaluation itself; the edit handler only starts the debounce timer
+        start = time.perf_counter()
+        await super().evaluate_edit(message)
+        self.edit_latencies.append(time.perf_counter() - start)
+
+
+class PerspectiveStub:
+    '''
+    Minimal stand-in for the Perspective API on localhost, served from its own thread and event loop
+    so it doesn't compete with the bot for the loop being measured.
+    '''
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.requests = 0
+        self.loop = asyncio.new_event_loop()
+        self.port = None
+        self.started = threading.Event()
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+
+    async def analyze(self, request):
+        self.requests += 1
+        body = json.loads(await request.text())
+        await asyncio.sleep(self.latency)
+        return web.json_response({'attributeScores': {
+            attr: {'summaryScore': {'value': random.random() * 0.5, 'type': 'PROBABILITY'}}
+            for attr in body['requestedAttributes']
+        }})
+
+    def serve(self):
+        asyncio.set_event_loop(self.loop)
+        app = web.Application()
+        app.router.add_post('/v1alpha1/comments:analyze', self.analyze)
+        self.runner = web.AppRunner(app, access_log=None)
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        self.loop.run_until_complete(site.start())
+        self.port = self.runner.addresses[0][1]
+        self.started.set()
+        self.loop.run_forever()
+
+    def start(self):
+        self.thread.start()
+        self.started.wait()
+        return f'http://127.0.0.1:{self.port}/v1alpha1/comments:analyze'
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class ReportFlow:
+    '''
+    One user working through the DM reporting flow, one answer per dm event. Users wait for the bot
+    to answer before sending their next message.
+    '''
+
+    def __init__(self, user, channel, link):
+        self.user = user
+        self.channel = channel
+        broad = random.choice(['1', '1', '1', '2', '3', '4', '5'])
+        steps = ['report', link, broad]
+        if broad != '5':
+            steps.append('2' if broad == '1' else '1')
+        steps.append(random.choice(['Seen this going around a lot', 'please check', '']))
+        visibility = random.choice(['yes', 'no'])
+        steps.append(visibility)
+        if visibility == 'yes':
+            steps.append(random.choice(['mute', 'block']))
+        if random.random() < 0.1:
+            # Some reporters give up partway through
+            steps = steps[:random.randrange(1, len(steps))] + ['cancel']
+        self.steps = steps
+        self.busy = False
+
+
+class Workload:
+    '''
+    Generates events against the harness bot and records how long each handler took.
+    '''
+
+    def __init__(self, client, guild, posts, mix, reporters, latency):
+        self.client = client
+        self.guild = guild
+        self.posts = posts
+        self.types, self.weights = zip(*mix.items())
+        self.reporters = reporters
+        self.latency = latency
+        self.authors = [FakeUser(next(ids), f'member{i}') for i in range(200)]
+        self.recent = [] # Recent posts in the group channel, for edits and reports to pick from
+        self.flows = []
+        self.answered = set() # Reports a moderator has already replied to
+        self.latencies = defaultdict(list)
+        self.skipped = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.in_flight = set()
+
+    def dispatch(self, kind, coro):
+        async def timed():
+            start = time.perf_counter()
+            try:
+                await coro
+            except Exception:
+                # Count it, and show the first one so a broken handler doesn't go unnoticed
+                if not self.errors:
+                    traceback.print_exc()
+                self.errors[kind] += 1
+                return
+            self.latencies[kind].append(time.perf_counter() - start)
+        task = asyncio.get_running_loop().create_task(timed())
+        self.in_flight.add(task)
+        task.add_done_callback(self.in_flight.discard)
+
+    def event(self):
+        kind = random.choices(self.types, self.weights)[0]
+        if not getattr(self, kind)():
+            self.skipped[kind] += 1
+            self.post()
+
+    def post(self):
+        content = random.choice(self.posts) if random.random() < 0.8 else random.choice(CHATTER)
+        message = FakeMessage(content, random.choice(self.authors), self.guild.group)
+        self.guild.group.messages[message.id] = message
+        self.recent.append(message)
+        del self.recent[:-500]
+        self.dispatch('post', self.client.on_message(message))
+        return True
+
+    def edit(self):
+        if not self.recent:
+            return False
+        before = random.choice(self.recent)
+        roll = random.random()
+        if roll < 0.3:
+            content = before.content + '!!' # Punctuation only, the debouncer should skip it
+        elif roll < 0.6:
+            content = before.content + ' (edited)'
+        else:
+            content = random.choice(self.posts)
+        after = FakeMessage(content, before.author, before.channel, before.id)
+        self.guild.group.messages[after.id] = after
+        self.recent[self.recent.index(before)] = after
+        self.dispatch('edit', self.client.on_message_edit(before, after))
+        return True
+
+    def dm(self):
+        idle = [flow for flow in self.flows if not flow.busy]
+        if len(self.flows) < self.reporters and (not idle or random.random() < 0.3) and self.recent:
+            target = random.choice(self.recent)
+            link = f'https://discord.com/channels/{self.guild.id}/{target.channel.id}/{target.id}'
+            user = random.choice(self.authors)
+            if not any(flow.user is user for flow in self.flows):
+                flow = ReportFlow(user, FakeChannel(None, None, self.latency), link)
+                flow.channel.bot_user = self.client.user
+                self.flows.append(flow)
+                idle.append(flow)
+        if not idle:
+            return False
+        flow = random.choice(idle)
+        flow.busy = True
+        message = FakeMessage(flow.steps.pop(0), flow.user, flow.channel)
+
+        async def step():
+            try:
+                await self.client.on_message(message)
+            finally:
+                flow.busy = False
+                if not flow.steps:
+                    self.flows.remove(flow)
+        self.dispatch('dm', step())
+        return True
+
+    def mod(self):
+        reviewing = [report for report in self.client.modqueue.in_review.get(self.guild.id, {}).values()
+                     if report.prompt_id is not None and report.id not in self.answered]
+        if not reviewing:
+            return False
+        report = random.choice(reviewing)
+        self.answered.add(report.id)
+        answers = ['yes', 'no', 'unclear'] if report.broadCategory == 'Misinformation' else ['yes', 'no']
+        message = FakeMessage(random.choice(answers), random.choice(self.authors), self.guild.mod,
+                              reference=FakeReference(report.prompt_id))
+        self.dispatch('mod', self.client.on_message(message))
+        return True
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) * 1000 if values else float('nan')
+
+
+def summarize(latencies):
+    return {kind: {'count': len(values), 'p50': percentile(values, 50), 'p95': percentile(values, 95),
+                   'p99': percentile(values, 99), 'max': percentile(values, 100)}
+            for kind, values in latencies.items() if values}
+
+
+async def sample(client, workload, interval, samples):
+    # Queue depths over time, and how late the loop wakes us up as a measure of event loop lag
+    start = time.perf_counter()
+    while True:
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        now = time.perf_counter()
+        samples.append({
+            't': now - start,
+            'handlers': len(workload.in_flight),
+            'inference': client.scheduler.depth(),
+            'modqueue': len(client.modqueue),
+            'outbox': client.outbox.depth(),
+            'edits': len(client.edits.pending),
+            'flows': len(client.reports),
+            'lag_ms': (now - expected) * 1000,
+        })
+
+
+def load_posts(path, limit):
+    with open(path, newline='', encoding='utf-8') as f:
+        rows = [(row['label'], row['content']) for row in csv.DictReader(f) if row['content']]
+    labels = {normalize_text(content).key: LABEL_CODES[label] for label, content in rows if label in LABEL_CODES}
+    posts = [content for _, content in rows]
+    random.shuffle(posts)
+    return posts[:limit] if limit else posts, labels
+
+
+async def run(args, perspective_url, posts, labels):
+    guild = FakeGuild(args.discord_latency)
+    if args.backend == 'fake':
+        load = lambda: FakeModel(labels, args.batch_ms / 1000, args.item_ms / 1000)
+    else:
+        def load():
+            model = load_backend(args.backend, args.model)
+            model.predict(['Warming up the classifier.'] * 2)
+            return model
+    client = HarnessBot(guild, load, perspective_url)
+    workload = Workload(client, guild, posts, args.mix, args.reporters, args.discord_latency)
+
+    await client.on_ready()
+    await client.ready.wait()
+    print(f"warm-up took {client.startup['ready']:.1f}s, replaying {args.rate:g} events/s for {args.duration:g}s...")
+
+    samples = []
+    sampler = asyncio.get_running_loop().create_task(sample(client, workload, args.interval, samples))
+    start = time.perf_counter()
+    deadline = start + args.duration
+    next_event = start
+    dispatched = 0
+    while next_event < deadline:
+        delay = next_event - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        workload.event()
+        dispatched += 1
+        next_event += random.expovariate(args.rate)
+    offered = time.perf_counter() - start
+
+    # Let the handlers still running finish, up to a point
+    if workload.in_flight:
+        await asyncio.wait(list(workload.in_flight), timeout=args.drain)
+    elapsed = time.perf_counter() - start
+    unfinished = len(workload.in_flight)
+    sampler.cancel()
+    for task in list(workload.in_flight):
+        task.cancel()
+
+    latencies = dict(workload.latencies)
+    latencies['edit evaluation'] = client.edit_latencies
+    completed = sum(len(v) for k, v in workload.latencies.items())
+    result = {
+        'config': {k: v for k, v in vars(args).items() if k not in ('save', 'compare')},
+        'dispatched': dispatched,
+        'completed': completed,
+        'unfinished': unfinished,
+        'offered_rate': dispatched / offered,
+        'completed_rate': completed / elapsed,
+        'skipped': dict(workload.skipped),
+        'errors': dict(workload.errors),
+        'latency_ms': summarize(latencies),
+        'samples': samples,
+        'counters': {
+            'inference': client.scheduler.stats(),
+            'verdict cache': client.verdicts.stats(),
+            'recent messages': client.recent_messages.stats(),
+            'edits': client.edits.stats(),
+            'outbox': {'queued': client.outbox.queued, 'sent': client.outbox.sent, 'merged': client.outbox.merged, 'dropped': client.outbox.dropped},
+            'reactions': guild.group.reactions,
+        },
+    }
+    await client.outbox.drain(timeout=1)
+    for worker in client.outbox.workers.values():
+        worker.cancel()
+    await client.close()
+    return result
+
+
+def report(result, baseline=None):
+    print(f"\n{result['dispatched']} events dispatched at {result['offered_rate']:.1f}/s, "
+          f"{result['completed']} completed at {result['completed_rate']:.1f}/s, {result['unfinished']} unfinished")
+    if result['errors']:
+        print('handlers that raised: ' + ', '.join(f'{k} {v}' for k, v in result['errors'].items()))
+    if result['skipped']:
+        print('events replaced by a post for lack of a target: ' + ', '.join(f'{k} {v}' for k, v in result['skipped'].items()))
+
+    print(f"\n{'handler latency (ms)':<22}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for kind, row in result['latency_ms'].items():
+        line = f"{kind:<22}{row['count']:>8}" + ''.join(f'{row[q]:>10.1f}' for q in ('p50', 'p95', 'p99', 'max'))
+        old = (baseline or {}).get('latency_ms', {}).get(kind)
+        if old:
+            line += '   p99 ' + (f"{(row['p99'] - old['p99']) / old['p99']:+.0%} vs baseline" if old['p99'] else 'n/a')
+        print(line)
+
+    columns = ['handlers', 'inference', 'modqueue', 'outbox', 'edits', 'flows', 'lag_ms']
+    print(f"\n{'t (s)':>7}" + ''.join(f'{c:>11}' for c in columns))
+    for s in result['samples']:
+        print(f"{s['t']:>7.1f}" + ''.join(f'{s[c]:>11.0f}' for c in columns))
+
+    print()
+    for name, value in result['counters'].items():
+        print(f'{name}: {value}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data', default='../en_dup.csv')
+    parser.add_argument('--rate', type=float, default=20, help='events per second')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of traffic to replay')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='relative weights of post, edit, dm and mod events')
+    parser.add_argument('--reporters', type=int, default=20, help='most DM reporting flows open at once')
+    parser.add_argument('--posts', type=int, default=0, help='only sample from this many dataset rows, 0 for all')
+    parser.add_argument('--backend', default='fake', choices=['fake'] + list(BACKENDS))
+    parser.add_argument('--model', default=bot.MODEL_NAME)
+    parser.add_argument('--batch-ms', type=float, default=40, help='stand-in classifier cost per batch')
+    parser.add_argument('--item-ms', type=float, default=15, help='stand-in classifier cost per text')
+    parser.add_argument('--inference-socket', help='classify through a running inference_server.py instead of in-process')
+    parser.add_argument('--prefilter', default='', help='prefilter to put in front of the classifier')
+    parser.add_argument('--discord-latency', type=float, default=0.05, help='seconds per simulated Discord API call')
+    parser.add_argument('--perspective-latency', type=float, default=0.15, help='seconds per stub Perspective request')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between queue depth samples')
+    parser.add_argument('--drain', type=float, default=30, help='seconds to wait for unfinished handlers at the end')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='show p99 changes against results saved with --save')
+    args = parser.parse_args()
+
+    mix = {kind: float(weight) for kind, weight in (part.split('=') for part in args.mix.split(','))}
+    if not mix.keys() <= set(EVENT_TYPES):
+        parser.error('--mix can only weight ' + ', '.join(EVENT_TYPES))
+    args.mix = mix
+
+    random.seed(args.seed)
+    posts, labels = load_posts(args.data, args.posts)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    stub = PerspectiveStub(args.perspective_latency)
+    perspective_url = stub.start()
+    # Keep the bot's state files out of the working directory
+    with tempfile.TemporaryDirectory() as tmp:
+        bot.STORE_PATH = os.path.join(tmp, 'reports.db')
+        bot.VERDICTS_PATH = os.path.join(tmp, 'verdicts.json')
+        bot.PREFILTER_PATH = args.prefilter
+        bot.DATASET_PATH = args.data
+        bot.INFERENCE_SOCKET = args.inference_socket
+        try:
+            result = asyncio.run(run(args, perspective_url, posts, labels))
+        finally:
+            stub.stop()
+    result['perspective_requests'] = stub.requests
+
+    report(result, baseline)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
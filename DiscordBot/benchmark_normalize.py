@@ -0,0 +1,49 @@
+# benchmark_normalize.py
+'''
+Measures the throughput of the shared normalization stage on en_dup.csv, both for first-time
+messages and for memo hits (the same message seen again by another consumer).
+
+    python benchmark_normalize.py --repeat 3
+'''
+import argparse
+import csv
+import time
+from benchmark_load import FakeChannel, FakeMessage, FakeUser
+from normalize import Normalizer, load_vocabulary, normalize_text
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data', default='../en_dup.csv')
+    parser.add_argument('--repeat', type=int, default=3, help='passes over the data for each measurement')
+    args = parser.parse_args()
+
+    with open(args.data, newline='', encoding='utf-8') as f:
+        author, channel = FakeUser(0, 'poster'), FakeChannel('posts', None, latency=0)
+        messages = [FakeMessage(row['content'], author, channel) for row in csv.DictReader(f)]
+    chars = sum(len(m.content) for m in messages)
+
+    start = time.perf_counter()
+    vocabulary = load_vocabulary(args.data)
+    print(f'{len(messages)} messages, {chars / len(messages):.0f} characters on average')
+    print(f'vocabulary of {len(vocabulary)} words loaded in {time.perf_counter() - start:.2f}s\n')
+
+    def measure(label, fn):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for m in messages:
+                fn(m)
+        elapsed = time.perf_counter() - start
+        count = len(messages) * args.repeat
+        print(f'{label:<36}{count / elapsed:>12,.0f} msg/s{chars * args.repeat / elapsed / 1e6:>10.1f} MB/s')
+
+    measure('normalize_text, no leetspeak', lambda m: normalize_text(m.content))
+    measure('normalize_text, leetspeak folding', lambda m: normalize_text(m.content, vocabulary))
+    normalizer = Normalizer(max_entries=len(messages), vocabulary=vocabulary)
+    for m in messages:
+        normalizer.normalize(m)
+    measure('Normalizer, memo hits', normalizer.normalize)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# benchmark_reports.py
+'''
+Measures the memory held per in-progress reporting flow and the time each Report.handle_message
+transition takes, by driving thousands of flows with stand-in Discord objects.
+
+    python benchmark_reports.py --flows 10000
+'''
+import argparse
+import asyncio
+import gc
+import time
+import tracemalloc
+from benchmark_load import FakeChannel, FakeGuild, FakeMessage, FakeUser
+from messagecache import RecentMessages
+from normalize import Normalizer
+from report import Report
+
+# A reporter's answers after the initial `report`, ending in a complete report
+SCRIPT = ['https://discord.com/channels/{guild}/{channel}/{id}', '1', '2', 'Seen this one before', 'yes', 'mute']
+
+
+class FakeClient:
+    def __init__(self):
+        self.guild = FakeGuild(latency=0)
+        self.reporter = FakeUser(0, 'reporter')
+        # Keep nothing, so the cache doesn't show up in the per-flow memory
+        self.recent_messages = RecentMessages(max_messages=0)
+        self.normalizer = Normalizer(max_entries=0)
+
+    def get_guild(self, guild_id):
+        return self.guild if guild_id == self.guild.id else None
+
+
+async def run(flows, steps):
+    client = FakeClient()
+    group = client.guild.group
+    dm = FakeChannel('dm', None, latency=0)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    reports = {}
+    start = time.perf_counter()
+    transitions = 0
+    for i in range(flows):
+        # Roughly the size of a real message body; it leaves the channel's history once the flow is
+        # done with it, so all the flow holds on to is what the report kept
+        post = FakeMessage('Vitamin C megadoses cure COVID-19 within two days. ' * 4, FakeUser(i, f'user{i}'), group)
+        group.messages[post.id] = post
+        report = Report(client)
+        reports[i] = report
+        await report.handle_message(FakeMessage('report', client.reporter, dm))
+        for answer in SCRIPT[:steps]:
+            answer = answer.format(guild=client.guild.id, channel=group.id, id=post.id)
+            await report.handle_message(FakeMessage(answer, client.reporter, dm))
+            transitions += 1
+        del group.messages[post.id]
+    elapsed = time.perf_counter() - start
+
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return held / flows, elapsed / (transitions + flows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--flows', type=int, default=10000)
+    args = parser.parse_args()
+
+    print(f"{'flow abandoned after':<28}{'bytes/flow':>12}{'us/transition':>15}")
+    for steps, label in [(0, 'report'), (1, 'message link'), (3, 'specific category'), (len(SCRIPT), 'complete')]:
+        per_flow, per_transition = asyncio.run(run(args.flows, steps))
+        print(f'{label:<28}{per_flow:>12.0f}{per_transition * 1e6:>15.1f}')
+
+
+if __name__ == '__main__':
+    main()
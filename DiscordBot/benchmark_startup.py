@@ -0,0 +1,98 @@
+# benchmark_startup.py
+'''
+Compares how long the bot takes to come up when everything is loaded before connecting (how it used
+to start) with loading in the background after connecting (warm_up). For each mode it reports when
+the bot connected, when the classifier was ready, when a DM sent at connect time was answered and
+when a channel post sent at connect time was classified, all in seconds from start. Uses the stand-in
+Discord objects from benchmark_load.py; the known-claims index is the real one built from en_dup.csv.
+
+    python benchmark_startup.py --load-seconds 20 --runs 3
+    python benchmark_startup.py --backend quantized  # time the real classifier load instead
+'''
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import tempfile
+import time
+import numpy as np
+import bot
+from backends import load_backend, BACKENDS
+from benchmark_load import FakeGuild, FakeMessage, FakeChannel, FakeModel, FakeUser, HarnessBot, PerspectiveStub, load_posts
+
+
+async def start(args, mode, perspective_url, labels, post):
+    def load():
+        if args.backend == 'fake':
+            # Stands in for reading the checkpoint from disk and the first forward pass
+            time.sleep(args.load_seconds)
+            return FakeModel(labels, 0.04, 0.015)
+        model = load_backend(args.backend, args.model)
+        model.predict(['Warming up the classifier.'] * 2)
+        return model
+
+    guild = FakeGuild(0.05)
+    client = HarnessBot(guild, load, perspective_url)
+    if mode == 'before connecting':
+        await client.warm_up()
+        client.warmup = asyncio.get_running_loop().create_future() # Already warm, so on_ready doesn't start again
+    await asyncio.sleep(args.connect_seconds) # Logging in and the gateway handshake
+    await client.on_ready()
+
+    times = {'connect': client.startup['connect']}
+
+    async def timed(name, coro):
+        await coro
+        times[name] = time.perf_counter() - client.started
+
+    user = FakeUser(1, 'reporter')
+    message = FakeMessage(post, FakeUser(2, 'poster'), guild.group)
+    guild.group.messages[message.id] = message
+    await asyncio.gather(
+        timed('DM answered', client.on_message(FakeMessage('report', user, FakeChannel(None, None, 0.05)))),
+        timed('post classified', client.on_message(message)),
+        client.ready.wait(),
+    )
+    times['ready'] = client.startup['ready']
+    await client.outbox.drain(timeout=1)
+    for worker in client.outbox.workers.values():
+        worker.cancel()
+    await client.close()
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data', default='../en_dup.csv')
+    parser.add_argument('--backend', default='fake', choices=['fake'] + list(BACKENDS))
+    parser.add_argument('--model', default=bot.MODEL_NAME)
+    parser.add_argument('--load-seconds', type=float, default=20, help='how long the stand-in classifier takes to load')
+    parser.add_argument('--connect-seconds', type=float, default=1.0, help='simulated login and gateway handshake')
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    posts, labels = load_posts(args.data, 1)
+    stub = PerspectiveStub(0.15)
+    perspective_url = stub.start()
+    columns = ['connect', 'DM answered', 'ready', 'post classified']
+    print(f"{'mode (median of ' + str(args.runs) + ' runs)':<28}" + ''.join(f'{c:>17}' for c in columns))
+    try:
+        for mode in ['before connecting', 'in the background']:
+            runs = []
+            for _ in range(args.runs):
+                with tempfile.TemporaryDirectory() as tmp:
+                    bot.STORE_PATH = os.path.join(tmp, 'reports.db')
+                    bot.VERDICTS_PATH = os.path.join(tmp, 'verdicts.json')
+                    bot.PREFILTER_PATH = ''
+                    bot.DATASET_PATH = args.data
+                    # The bot's own startup prints would break up the table
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        runs.append(asyncio.run(start(args, mode, perspective_url, labels, posts[0])))
+            print(f'{mode:<28}' + ''.join(f'{np.median([r[c] for r in runs]):>16.1f}s' for c in columns))
+    finally:
+        stub.stop()
+
+
+if __name__ == '__main__':
+    main()
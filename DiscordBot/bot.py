@@ -1,35 +1,55 @@
 # bot.py
 import discord
 from discord.ext import commands
-from unidecode import unidecode # for disguised unicode characters
-from simpletransformers.classification import ClassificationModel # for loading Simple Transformer classification model
 import os
 import json
 import logging
 import re
-import requests
 import random
-from report import Report
+import asyncio
+import time
+from report import Report, MessageRef, REPORT_TIMEOUT
+from inference import InferenceScheduler, InferenceClient
+from perspective import PerspectiveClient
+from cache import VerdictCache
+from duplicates import DuplicateIndex, LABEL_CODES
+from backends import load_backend
+from prefilter import Prefilter, Cascade
+from modqueue import ModerationQueue, confidence, priority
+from store import ReportStore
+from messagecache import RecentMessages
+from dispatcher import Outbox
+from edits import EditDebouncer
+from normalize import Normalizer, load_vocabulary
+from logs import setup_logging
+import metrics
 
 N_THRESHOLD = 2
+MODEL_NAME = 'checkpoint-3750-epoch-10'
+INFERENCE_BACKEND = 'simpletransformers' # or 'quantized' / 'onnx', see benchmark_backends.py
+MODEL_VERSION = MODEL_NAME + '/' + INFERENCE_BACKEND # Quantized outputs can differ slightly, so they get their own cache entries; a shared inference server reports its own
+PERSPECTIVE_VERSION = 'perspective-v1alpha1'
+DATASET_PATH = '../en_dup.csv'
+PREFILTER_PATH = 'prefilter.pkl' # Trained with `python prefilter.py`
+STORE_PATH = 'reports.db'
+VERDICTS_PATH = 'verdicts.json'
+MODEL_LOAD_ATTEMPTS = 3
+METRICS_HOST = '127.0.0.1' # Only reachable from this machine
+METRICS_PORT = int(os.environ.get('MODBOT_METRICS_PORT', 9152)) # Give each bot on a machine its own; 0 turns metrics off
+INFERENCE_SOCKET = None # Path of a shared inference_server.py to use instead of loading the model in this process
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
-# Set up logging to the console
 logger = logging.getLogger('discord')
-logger.setLevel(logging.DEBUG)
-handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
-handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-logger.addHandler(handler)
-
-# There should be a file called 'token.json' inside the same folder as this file
-token_path = 'tokens.json'
-if not os.path.isfile(token_path):
-    raise Exception(f"{token_path} not found!")
-with open(token_path) as f:
-    # If you get an error here, it means your token is formatted incorrectly. Did you put it in quotes?
-    tokens = json.load(f)
-    discord_token = tokens['discord']
-    perspective_key = tokens['perspective']
+
+LABEL_NAMES = {code: label for label, code in LABEL_CODES.items()}
+AUTO_FLAGS = metrics.counter('modbot_auto_flags_total', 'Channel posts flagged by the classifier, by predicted label.', labelnames=('label',))
+EVAL_TEXT_SECONDS = metrics.histogram('modbot_eval_text_seconds', 'Time to get Perspective scores for an edited message, cache hits included.')
+
+
+def log_task_failure(task):
+    # Background tasks nobody awaits would otherwise only report errors when garbage-collected, if at all
+    if not task.cancelled() and task.exception() is not None:
+        logger.error('background task %s failed', task.get_name(), exc_info=task.exception())
 
 
 class ModBot(discord.Client):
@@ -38,15 +58,66 @@ class ModBot(discord.Client):
         super().__init__(command_prefix='.', intents=intents)
         self.group_num = None
         self.mod_channels = {} # Map from guild to the mod channel id for that guild
-        self.reports = {} # Map from user IDs to the state of their report
+        self.reports = {} # Map from user IDs to the state of the report they are filling in
+        self.recent_messages = RecentMessages() # Channel messages we've seen, so reports rarely need fetch_message
+        self.outbox = Outbox() # Queues, merges and paces everything we send so handlers don't wait on rate limits
+        self.normalizer = Normalizer() # Normalizes each message once for every consumer below
+        self.edits = EditDebouncer(self.evaluate_edit, lambda message: self.normalizer.normalize(message).key) # Only re-scores an edited message once its edits settle
         self.perspective_key = key
-        self.currReportAuthor = None
-        self.currReportID = None
-        self.currReport = None
-        self.karma = {}  # Map from user IDs to the number of times they've been reported
-        self.queue = [] # List for the queue of user reports waiting for moderator response
-        # Loading our saved Simple Transformer classifier model
-        self.model = ClassificationModel(model_type='roberta', model_name='checkpoint-3750-epoch-10', use_cuda=False) 
+        self.perspective = PerspectiveClient(key)
+        # Reports and karma survive restarts in SQLite; pending reports go back in the queue once we're connected
+        self.store = ReportStore(STORE_PATH)
+        self.karma = self.store.load_karma()  # Map from user IDs to the number of times they've been reported
+        self.restored, last_id = self.store.load_pending()
+        self.modqueue = ModerationQueue(last_id=last_id) # Per-guild priority queues of reports waiting for moderator response
+        # The classifier is loaded in the background once we're connected (see warm_up), so DMs work right away
+        # and channel messages wait on self.ready until it can classify them
+        self.model = None
+        self.ready = asyncio.Event()
+        self.warmup = None
+        self.sweeper = None # Task expiring idle reporting flows; kept here so it isn't garbage-collected
+        self.background = set() # Fire-and-forget tasks (see spawn), referenced until they finish
+        self.buffered = 0 # Channel messages waiting for the classifier to be ready
+        self.startup = {} # Seconds from start to each startup milestone
+        self.started = time.perf_counter()
+        # Batches classifier calls and runs them off the event loop, or hands them to the shared inference server
+        self.scheduler = InferenceClient(INFERENCE_SOCKET) if INFERENCE_SOCKET else InferenceScheduler(None)
+        # If a prefilter has been trained, warm_up puts it in front of RoBERTa to decide the obvious cases
+        self.classifier = self.scheduler
+        self.model_version = MODEL_VERSION
+        # Remembers verdicts for texts we've already scored so repeat posts skip inference
+        self.verdicts = VerdictCache(path=VERDICTS_PATH)
+        # Groups near-identical channel posts so a copy-paste campaign becomes a single report
+        self.duplicates = DuplicateIndex()
+
+        # Served on METRICS_PORT once we log in (see setup_hook)
+        self.metrics_server = None
+        metrics.gauge('modbot_queued_reports', 'Reports waiting for or under moderator review.', lambda: len(self.modqueue))
+        metrics.gauge('modbot_open_report_flows', 'DM reporting flows in progress.', lambda: len(self.reports))
+        metrics.gauge('modbot_karma_users', 'Users in the karma table.', lambda: len(self.karma))
+        metrics.gauge('modbot_outbox_depth', 'Outgoing messages waiting to be sent.', self.outbox.depth)
+        metrics.gauge('modbot_inference_pending', 'Texts waiting for the classifier.',
+                      lambda: self.scheduler.depth())
+        metrics.gauge('modbot_prefilter_offloaded_ratio', 'Share of classified texts the prefilter decided without the full model.',
+                      lambda: self.cascade_stat('offloaded'))
+        metrics.gauge('modbot_prefilter_audited_recall', "Share of audited texts the full model flagged that the prefilter flagged too.",
+                      lambda: self.cascade_stat('audited_recall'))
+
+    def cascade_stat(self, name):
+        # NaN until there is something to measure (or when no prefilter is in use)
+        if not isinstance(self.classifier, Cascade):
+            return float('nan')
+        value = self.classifier.stats()[name]
+        return float('nan') if value is None else value
+
+    async def setup_hook(self):
+        if not METRICS_PORT:
+            return
+        try:
+            self.metrics_server = await metrics.serve(METRICS_HOST, METRICS_PORT)
+        except OSError:
+            # Usually another bot on this machine already has the port; moderation matters more than metrics
+            logger.error('could not serve metrics on %s:%s, carrying on without them', METRICS_HOST, METRICS_PORT, exc_info=True)
 
     async def on_ready(self):
         print(f'{self.user.name} has connected to Discord! It is these guilds:')
@@ -67,6 +138,128 @@ class ModBot(discord.Client):
                 if channel.name == f'group-{self.group_num}-mod':
                     self.mod_channels[guild.id] = channel
 
+        await self.restore_reports()
+
+        if 'connect' not in self.startup:
+            self.startup['connect'] = time.perf_counter() - self.started
+            print(f"Connected {self.startup['connect']:.1f}s after start, loading the classifier in the background.")
+        if self.warmup is None:
+            self.warmup = asyncio.get_running_loop().create_task(self.warm_up())
+            self.warmup.add_done_callback(log_task_failure)
+        if self.sweeper is None:
+            self.sweeper = asyncio.get_running_loop().create_task(self.expire_reports())
+            self.sweeper.add_done_callback(log_task_failure)
+
+    async def warm_up(self):
+        '''
+        Loads the classifier, prefilter and known-claims index on worker threads, runs a dummy batch through
+        the model so the first real message doesn't pay for lazy initialisation, then marks the bot ready.
+        The prefilter and the index are optional: if one fails to load the bot carries on without it. If the
+        classifier still can't be loaded after a few attempts the bot shuts down rather than hold every
+        channel message forever.
+        '''
+        loop = asyncio.get_running_loop()
+        try:
+            model, prefilter, duplicates = await asyncio.gather(
+                self.load_classifier(),
+                self.load_optional('prefilter', lambda: loop.run_in_executor(None, self.load_prefilter), None),
+                self.load_optional('known-claims index', lambda: loop.run_in_executor(None, self.load_duplicates),
+                                   (DuplicateIndex(), frozenset())),
+            )
+        except Exception:
+            logger.critical('could not load the classifier, shutting down', exc_info=True)
+            print('Could not load the classifier, shutting down. See discord.log for the error.')
+            await self.close()
+            return
+        if model is not None:
+            self.model = model
+            self.scheduler.model = model
+        if prefilter is not None:
+            self.classifier = Cascade(prefilter, self.scheduler)
+            self.model_version += '+prefilter'
+        self.duplicates, vocabulary = duplicates
+        self.normalizer.set_vocabulary(vocabulary)
+        self.startup['ready'] = time.perf_counter() - self.started
+        self.ready.set()
+        print(f"Classifier ready {self.startup['ready']:.1f}s after start, {self.buffered} buffered channel messages to classify.")
+
+    async def expire_reports(self, interval=60):
+        '''
+        Periodically drops reporting flows whose reporter has gone quiet for longer than REPORT_TIMEOUT.
+        '''
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            stale = [author_id for author_id, report in self.reports.items() if report.idle_for(now) > REPORT_TIMEOUT]
+            for author_id in stale:
+                del self.reports[author_id]
+            logger.info('recent message cache: %s', self.recent_messages.stats())
+            logger.info('edits: %s', self.edits.stats())
+
+    async def load_classifier(self, attempts=MODEL_LOAD_ATTEMPTS):
+        loop = asyncio.get_running_loop()
+        for attempt in range(attempts):
+            try:
+                if INFERENCE_SOCKET is None:
+                    return await loop.run_in_executor(None, self.load_model)
+                return await self.connect_inference_server()
+            except Exception:
+                if attempt == attempts - 1:
+                    raise
+                logger.exception('loading the classifier failed (attempt %d of %d), retrying', attempt + 1, attempts)
+                await asyncio.sleep(5 * (attempt + 1))
+
+    async def load_optional(self, name, load, fallback):
+        try:
+            return await load()
+        except Exception:
+            logger.exception('could not load the %s, carrying on without it', name)
+            return fallback
+
+    def load_model(self):
+        # Loading our saved Simple Transformer classifier model
+        model = load_backend(INFERENCE_BACKEND, MODEL_NAME)
+        model.predict(['Warming up the classifier.'] * 2)
+        return model
+
+    async def connect_inference_server(self, attempts=30):
+        # The server may still be loading the model, so keep trying for a while
+        for attempt in range(attempts):
+            try:
+                await self.scheduler.connect()
+                # Verdicts are cached per model version, so use whatever the server is actually serving
+                self.model_version = await self.scheduler.version()
+                return None
+            except (FileNotFoundError, ConnectionError):
+                if attempt == attempts - 1:
+                    raise
+                await asyncio.sleep(2)
+
+    def load_prefilter(self):
+        if os.path.isfile(PREFILTER_PATH):
+            return Prefilter.load(PREFILTER_PATH)
+        return None
+
+    def load_duplicates(self):
+        # The dataset's vocabulary also tells the normalizer which leetspeak spellings to fold
+        duplicates = DuplicateIndex()
+        vocabulary = frozenset()
+        if os.path.isfile(DATASET_PATH):
+            vocabulary = load_vocabulary(DATASET_PATH)
+            duplicates.load_csv(DATASET_PATH, vocabulary=vocabulary)
+        return duplicates, vocabulary
+
+    async def close(self):
+        # Release the worker thread and the pooled Perspective connections, and flush pending writes, before disconnecting
+        await self.outbox.drain()
+        await self.scheduler.close()
+        await self.perspective.close()
+        self.verdicts.save()
+        await asyncio.get_running_loop().run_in_executor(None, self.store.close)
+        if self.metrics_server is not None:
+            await self.metrics_server.cleanup()
+        await super().close()
+
     async def on_message(self, message):
         '''
         This function is called whenever a message is sent in a channel that the bot can see (including DMs). 
@@ -78,19 +271,26 @@ class ModBot(discord.Client):
 
         # Check if this message was sent in a server ("guild") or if it's a DM
         if message.guild:
+            self.recent_messages.put(message)
             await self.handle_channel_message(message)
         else:
             await self.handle_dm(message)
 
     async def on_message_edit(self, before, after):
+        if after.guild:
+            self.recent_messages.put(after)
         await self.handle_channel_edit(after)
 
+    async def on_raw_message_delete(self, payload):
+        # Deleted messages shouldn't be reportable from the cache
+        self.recent_messages.discard(payload.message_id)
+
     async def handle_dm(self, message):
         # Handle a help message
         if message.content == Report.HELP_KEYWORD:
             reply =  "Use the `report` command to begin the reporting process.\n"
             reply += "Use the `cancel` command to cancel the report process.\n"
-            await message.channel.send(reply)
+            self.outbox.send(message.channel, reply)
             return
 
         author_id = str(message.author.id)
@@ -102,98 +302,182 @@ class ModBot(discord.Client):
 
         # If we don't currently have an active report for this user, add one
         if author_id not in self.reports:
-            self.queue.append(author_id)
             self.reports[author_id] = Report(self)
             self.reports[author_id].reporter = message.author.name
 
         # Let the report class handle this message; forward all the messages it returns to us
         responses = await self.reports[author_id].handle_message(message)
         for r in responses:
-            await message.channel.send(r)
-        
-        reported_id = self.reports[author_id].reportedMessage.author.id
-        # If no track record of author_id, add one
-        if reported_id not in self.karma:
-            self.karma[reported_id] = 0
+            self.outbox.send(message.channel, r)
 
         # If the report is complete or cancelled, remove it from our map
         if self.reports[author_id].report_complete():
-            # If the report was properly completed, finish flow on moderator's side
+            report = self.reports.pop(author_id)
+            # If the report was properly completed, hand it over to the moderators' queue
             if not message.content == 'cancel':
-                self.karma[reported_id] += 1          # increment author_id record by one
-                # Only start the moderator's reporting flow if this report is at the front of the queue
-                if len(self.queue) == 1:
-                    await self.start_mod_flow()
-            else:
-                self.queue.pop(0)
-                self.reports.pop(author_id)
-    
+                reported_id = report.reportedMessage.author_id
+                self.karma[reported_id] = self.karma.get(reported_id, 0) + 1          # increment author_id record by one
+                self.store.increment_karma(reported_id)
+                await self.submit_report(report)
+
+    async def submit_report(self, report):
+        '''
+        Queues a finished report for its guild's moderators and shows it right away if a review slot is free.
+        '''
+        guild_id = report.reportedMessage.guild_id
+        karma = self.karma.get(report.reportedMessage.author_id, 0)
+        self.modqueue.push(guild_id, report, priority(report, karma))
+        self.store.add_report(report)
+        await self.start_mod_flow(guild_id)
+
+    async def restore_reports(self):
+        '''
+        Puts the reports that were still pending when the bot last stopped back into the moderation queue.
+        '''
+        guild_ids = set()
+        for row in self.restored:
+            guild = self.get_guild(row['guild_id'])
+            channel = guild.get_channel(row['channel_id']) if guild else None
+            if channel is None:
+                continue
+            report = Report(self)
+            report.id = row['id']
+            report.created = row['created']
+            report.reporter = row['reporter']
+            report.broadCategory = row['broad_category']
+            report.specificCategory = row['specific_category']
+            report.optionalMessage = row['optional_message']
+            report.postVisibility = row['post_visibility']
+            report.userVisibility = row['user_visibility']
+            report.confidence = row['confidence']
+            report.reportedMessage = MessageRef(channel, row['message_id'], row['reported_user_id'], row['reported_user_name'], row['content'])
+            self.modqueue.push(guild.id, report, priority(report, self.karma.get(row['reported_user_id'], 0)))
+            guild_ids.add(guild.id)
+        self.restored = []
+        for guild_id in guild_ids:
+            await self.start_mod_flow(guild_id)
+
     # changing this from a regular def function to an async function
-    async def start_mod_flow(self): 
-        if len(self.queue) == 0:
-            return
-        # Sending the report message for the first item is the self.queue list   
-        self.currReportID = self.queue[0]
-        self.currReport = self.reports[self.currReportID]
-        self.currReportAuthor = self.currReport.reporter
-        reported_m = self.currReport.reportedMessage         
-        mod_channel = self.mod_channels[reported_m.guild.id]
-
-        if self.currReportAuthor == 'auto':
-            reply = "NEW REPORT \nmade by `COVID-19 misinformation Bot " + "` regarding a post by `" + reported_m.author.name + "`"
-            reply += "\n\n And here is the message content: ```" + reported_m.content + "```"
-            reply += "\nIs a response necessary? Please enter `yes` or `no`."
-            await mod_channel.send(reply)
-        else:
-            # Foward the complete report to the mod channel
-            reply = "NEW REPORT \nmade by `" + self.currReportAuthor + "` regarding a post by `" + reported_m.author.name + "`"
-            reply += "\n• The message reported falls under **" + self.currReport.broadCategory + "**"
-            reply += "\n• And is more specifically related to **" + self.currReport.specificCategory + "**"
-            reply += "\n• Here is an optional message from the reporter: **" + self.currReport.optionalMessage + "**"
-            reply += "\n• Would the reporter like to no longer see posts from the same user? **" + self.currReport.postVisibility + "**"       
-            if self.currReport.postVisibility == 'yes':
-                reply += "\nHow would the reporter like to change the status of the offending user's relationship with them? **" + self.currReport.userVisibility + "**"
-            reply += "\n\n And here is the message content: ```" + reported_m.content + "```"
-            if self.karma[reported_m.author.id] >= N_THRESHOLD:
-                reply += "ATTENTION: This user has been reported " + str(N_THRESHOLD) + " times. It may be appropriate to take further action by restricting this user."
-            if self.currReport.broadCategory == 'Misinformation':
-                reply += "\nIs a response necessary? Please enter `yes`, `no`, or `unclear`."
-            else:
+    async def start_mod_flow(self, guild_id): 
+        # Show the most urgent waiting reports until every review slot for this guild is taken
+        while True:
+            report = self.modqueue.next_for_review(guild_id)
+            if report is None:
+                return
+            reported_m = report.reportedMessage
+            mod_channel = self.mod_channels[guild_id]
+
+            if report.reporter == 'auto':
+                reply = "NEW REPORT #" + str(report.id) + "\nmade by `COVID-19 misinformation Bot " + "` regarding a post by `" + reported_m.author_name + "`"
+                reply += "\n\n And here is the message content: ```" + reported_m.content + "```"
                 reply += "\nIs a response necessary? Please enter `yes` or `no`."
-            await mod_channel.send(reply)
+            else:
+                # Foward the complete report to the mod channel
+                reply = "NEW REPORT #" + str(report.id) + "\nmade by `" + report.reporter + "` regarding a post by `" + reported_m.author_name + "`"
+                reply += "\n• The message reported falls under **" + report.broadCategory + "**"
+                reply += "\n• And is more specifically related to **" + report.specificCategory + "**"
+                reply += "\n• Here is an optional message from the reporter: **" + report.optionalMessage + "**"
+                reply += "\n• Would the reporter like to no longer see posts from the same user? **" + report.postVisibility + "**"       
+                if report.postVisibility == 'yes':
+                    reply += "\nHow would the reporter like to change the status of the offending user's relationship with them? **" + report.userVisibility + "**"
+                reply += "\n\n And here is the message content: ```" + reported_m.content + "```"
+                if self.karma.get(reported_m.author_id, 0) >= N_THRESHOLD:
+                    reply += "ATTENTION: This user has been reported " + str(N_THRESHOLD) + " times. It may be appropriate to take further action by restricting this user."
+                if report.broadCategory == 'Misinformation':
+                    reply += "\nIs a response necessary? Please enter `yes`, `no`, or `unclear`."
+                else:
+                    reply += "\nIs a response necessary? Please enter `yes` or `no`."
+            reply += "\n(Reply to this message, or start your answer with `#" + str(report.id) + "`, when several reports are open.)"
+            try:
+                prompt = await self.outbox.send(mod_channel, reply, alone=True)
+            except Exception:
+                # Put the report back in line rather than leave it in review with nothing to answer;
+                # it's shown again the next time this guild's flow runs
+                logger.exception('could not show report #%s to the moderators', report.id)
+                self.modqueue.finish(report)
+                self.modqueue.push(guild_id, report, priority(report, self.karma.get(reported_m.author_id, 0)))
+                return
+            self.modqueue.track_prompt(prompt.id, report)
 
     async def handle_mod_message(self, message): 
         mod_channel = self.mod_channels[message.guild.id]
-        author_id = self.currReportID
-        if message.content == 'yes':
-            # Post needs to be removed
-            await self.currReport.reportedMessage.add_reaction('❌') 
-            await mod_channel.send("This post has been deleted. This post removal is symbolized by the ❌ reaction on it.")
-        elif author_id != "auto" and self.currReport.broadCategory == 'Misinformation':
-            # If not misinfo but high risk, add warning and de prioritize
-            if message.content == 'no':
-                await self.handle_special_cases() 
-                await mod_channel.send("This post has been de-prioritized and given a warning label. These actions are symbolized by the 🔻 and ⭕ reactions respectively")
-            if message.content == 'unclear':
-                # send to fact checker function
-                if random.randrange(100) < 50:
-                    await self.currReport.reportedMessage.add_reaction('❌') 
-                    await mod_channel.send("This post has been classified as false by the fact checker so it had been deleted. This post removal is symbolized by the ❌ reaction on it.")
+        report, answer = self.modqueue.route(message.guild.id, message)
+        if report is None:
+            open_ids = self.modqueue.reviewing(message.guild.id)
+            if len(open_ids) > 1 and answer.lower() in {'yes', 'no', 'unclear'}:
+                # Looks like an answer, but we can't tell which report it's for
+                self.outbox.send(mod_channel, "Several reports are open (" + ", ".join("#" + str(i) for i in open_ids) + "). Reply to the report's message, or start your answer with its number, e.g. `#" + str(open_ids[0]) + " " + answer.lower() + "`.")
+            return
+        valid_answers = {'yes', 'no', 'unclear'} if report.broadCategory == 'Misinformation' else {'yes', 'no'}
+        if answer not in valid_answers:
+            self.outbox.send(mod_channel, "Report #" + str(report.id) + ": please enter " + ", ".join("`" + a + "`" for a in sorted(valid_answers)) + ".")
+            return
+        # Take the report out of review before anything is awaited, so a second answer arriving in the
+        # meantime can't be routed to it and decide it twice
+        self.modqueue.finish(report)
+
+        cluster = report.cluster
+        duplicates = []
+        if cluster is not None:
+            # The decision covers every near-duplicate of the reported post in this guild, including future ones
+            cluster.decide(message.guild.id, answer)
+            duplicates = cluster.take_messages(message.guild.id)
+        try:
+            if answer == 'yes':
+                # Post needs to be removed
+                if len(duplicates) > 1:
+                    # Reacting to each post takes a request apiece, so don't hold up the next report for it
+                    self.spawn(self.react_all(duplicates, '❌'))
+                    self.outbox.send(mod_channel, "This post and " + str(len(duplicates) - 1) + " near-identical posts have been deleted. These post removals are symbolized by the ❌ reaction on them.")
                 else:
-                    await self.handle_special_cases() 
-                    await mod_channel.send("This post has been classified as true by the fact checker so it has only been de-prioritized and given a warning label. These actions are symbolized by the 🔻 and ⭕ reactions respectively.")
-        # deal with karma here - if karma bad, suspend user
-        # Start next report if it exists
-        self.queue.pop(0)
-        self.reports.pop(author_id)
-        await self.start_mod_flow()
+                    await report.reportedMessage.add_reaction('❌') 
+                    self.outbox.send(mod_channel, "This post has been deleted. This post removal is symbolized by the ❌ reaction on it.")
+            elif report.reporter != "auto" and report.broadCategory == 'Misinformation':
+                # If not misinfo but high risk, add warning and de prioritize
+                if answer == 'no':
+                    await self.handle_special_cases(report) 
+                    self.outbox.send(mod_channel, "This post has been de-prioritized and given a warning label. These actions are symbolized by the 🔻 and ⭕ reactions respectively")
+                if answer == 'unclear':
+                    # send to fact checker function
+                    if random.randrange(100) < 50:
+                        await report.reportedMessage.add_reaction('❌') 
+                        self.outbox.send(mod_channel, "This post has been classified as false by the fact checker so it had been deleted. This post removal is symbolized by the ❌ reaction on it.")
+                    else:
+                        await self.handle_special_cases(report) 
+                        self.outbox.send(mod_channel, "This post has been classified as true by the fact checker so it has only been de-prioritized and given a warning label. These actions are symbolized by the 🔻 and ⭕ reactions respectively.")
+        except discord.HTTPException:
+            # Usually the reported post was deleted in the meantime; the decision still stands
+            logger.warning('could not apply the decision on report #%s', report.id, exc_info=True)
+        finally:
+            # deal with karma here - if karma bad, suspend user
+            # Start next report if it exists, whatever happened above, so the guild's queue keeps moving
+            self.store.close_report(report, answer)
+            await self.start_mod_flow(message.guild.id)
         return
     
-    async def handle_special_cases(self):
+    def spawn(self, coro):
+        '''
+        Runs coro in the background, keeping a reference to it until it's done and logging any failure.
+        '''
+        task = asyncio.get_running_loop().create_task(coro)
+        self.background.add(task)
+        task.add_done_callback(self.background.discard)
+        task.add_done_callback(log_task_failure)
+        return task
+
+    async def react_all(self, messages, emoji):
+        for m in messages:
+            try:
+                await m.add_reaction(emoji)
+            except discord.HTTPException:
+                # Usually the post was deleted in the meantime; the rest still need the reaction
+                logger.warning('could not react to message %s', m.id, exc_info=True)
+
+    async def handle_special_cases(self, report):
         # Check if it is high risk
-        if self.currReport.specificCategory in {'Elections', 'Covid-19', 'Other Health or Medical'}:
-            await self.currReport.reportedMessage.add_reaction('🔻') # this emoji represents de-prioritization (ie shown to less people) 
-            await self.currReport.reportedMessage.add_reaction('⭕') # this emoji represents a warning label
+        if report.specificCategory in {'Elections', 'Covid-19', 'Other Health or Medical'}:
+            await report.reportedMessage.add_reaction('🔻') # this emoji represents de-prioritization (ie shown to less people) 
+            await report.reportedMessage.add_reaction('⭕') # this emoji represents a warning label
         return
 
     async def handle_channel_message(self, message):
@@ -206,71 +490,125 @@ class ModBot(discord.Client):
         if not message.channel.name == f'group-{self.group_num}':
             return
 
+        # Remember the posted version so edits can be compared against it
+        self.edits.seen(message)
+
         # Forward the message to the mod channel
         mod_channel = self.mod_channels[message.guild.id]
-        await mod_channel.send(f'Forwarded message:\n{message.author.name}: "{message.content}"')
-
-        # Use the classifier to determine if the message contains misinformation
-        predictions, raw_output = self.model.predict([message.content])
-        if predictions[0] == 0 or predictions[0] == 2:
+        # Every post is forwarded, so these are what's dropped if the mod channel can't keep up
+        self.outbox.send(mod_channel, f'Forwarded message:\n{message.author.name}: "{message.content}"', droppable=True)
+
+        # Hold the message until the classifier has finished loading
+        if not self.ready.is_set():
+            self.buffered += 1
+            await self.ready.wait()
+            self.buffered -= 1
+
+        # Near-duplicates of a known or already classified post reuse its verdict instead of running the classifier
+        normalized = self.normalizer.normalize(message)
+        cluster = self.duplicates.match(normalized.key)
+        if cluster.verdict is None:
+            # Use the classifier to determine if the message contains misinformation
+            prediction, raw_output = await self.classify(normalized)
+            cluster.verdict = prediction
+            cluster.confidence = confidence(raw_output)
+        if cluster.verdict == 0 or cluster.verdict == 2:
+            AUTO_FLAGS.inc(label=LABEL_NAMES[cluster.verdict])
+            decision = cluster.decision(message.guild.id)
+            if decision == 'yes':
+                # A moderator already ruled on this claim, so apply the same decision straight away
+                await message.add_reaction('❌')
+                self.outbox.send(mod_channel, "This post is a near-duplicate of a post that was already deleted, so it has been deleted too. This post removal is symbolized by the ❌ reaction on it.")
+                return
+            if decision is not None:
+                # Already cleared by a moderator
+                return
+            reported = MessageRef.from_message(message)
+            cluster.add_message(message.guild.id, reported)
+            if message.guild.id in cluster.reports:
+                # Already waiting in the queue, the pending decision will cover this post too
+                return
             # If content is COVID misinformation, automatic flag and generate report to mod channel
             report = Report(self)
-            report.reportedMessage = message
+            report.reportedMessage = reported
             report.reporter = 'auto'
-            self.reports['auto'] = report
-            self.queue.append('auto')
-            if len(self.queue) == 1:
-                await self.start_mod_flow()
+            report.cluster = cluster
+            report.confidence = cluster.confidence
+            cluster.reports[message.guild.id] = report
+            await self.submit_report(report)
 
-    async def handle_channel_edit(self, message):
-        # Send the info to mod function if necessary
-        if message.channel.name == f'group-{self.group_num}-mod':
-            await self.handle_mod_message(message)
+    async def classify(self, normalized):
+        '''
+        Given normalized text, returns the classifier's (prediction, raw_output), reusing a cached verdict when possible.
+        '''
+        verdict = self.verdicts.get(self.model_version, normalized.key)
+        if verdict is None:
+            prediction, raw_output = await self.classifier.predict(normalized.text)
+            verdict = [int(prediction), [float(x) for x in raw_output]]
+            self.verdicts.put(self.model_version, normalized.key, verdict)
+            if 'first_classification' not in self.startup:
+                self.startup['first_classification'] = time.perf_counter() - self.started
+                print(f"First classification {self.startup['first_classification']:.1f}s after start.")
+        return verdict[0], verdict[1]
 
-        # Only handle messages sent in the "group-#" channel
+    async def handle_channel_edit(self, message):
+        # Only handle messages sent in the "group-#" channel; edits in the mod channel are ignored
+        # so a moderator correcting their answer can't decide another report
         if not message.channel.name == f'group-{self.group_num}':
             return
 
+        # Wait for the edits to settle, and skip them entirely if the words didn't change
+        self.edits.submit(message)
+
+    async def evaluate_edit(self, message):
         # Forward the message to the mod channel
         mod_channel = self.mod_channels[message.guild.id]
-        await mod_channel.send(f'ALERT: message has been edited! Forwarded message:\n{message.author.name}: "{message.content}"')
+        self.outbox.send(mod_channel, f'ALERT: message has been edited! Forwarded message:\n{message.author.name}: "{message.content}"')
 
-        scores = self.eval_text(message)
-        await mod_channel.send(self.code_format(json.dumps(scores, indent=2)))
+        scores = await self.eval_text(message)
+        self.outbox.send(mod_channel, self.code_format(json.dumps(scores, indent=2)))
 
-    def eval_text(self, message):
+    async def eval_text(self, message):
         '''
         Given a message, forwards the message to Perspective and returns a dictionary of scores.
         '''
         
-        # Transliterate unicode string into closest possible representation in ASCII text
-        message.content = unidecode(message.content)
-
-        PERSPECTIVE_URL = 'https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze'
-
-        url = PERSPECTIVE_URL + '?key=' + self.perspective_key
-        data_dict = {
-            'comment': {'text': message.content},
-            'languages': ['en'],
-            'requestedAttributes': {
-                                    'SEVERE_TOXICITY': {}, 'PROFANITY': {},
-                                    'IDENTITY_ATTACK': {}, 'THREAT': {},
-                                    'TOXICITY': {}, 'FLIRTATION': {}
-                                },
-            'doNotStore': True
-        }
-        response = requests.post(url, data=json.dumps(data_dict))
-        response_dict = response.json()
-
-        scores = {}
-        for attr in response_dict["attributeScores"]:
-            scores[attr] = response_dict["attributeScores"][attr]["summaryScore"]["value"]
-
-        return scores
+        with EVAL_TEXT_SECONDS.time():
+            # Transliterated and de-obfuscated text from the shared normalization stage; the message itself is left alone
+            normalized = self.normalizer.normalize(message)
+
+            scores = self.verdicts.get(PERSPECTIVE_VERSION, normalized.key)
+            if scores is None:
+                scores = await self.perspective.score(normalized.text)
+                self.verdicts.put(PERSPECTIVE_VERSION, normalized.key, scores)
+            return scores
 
     def code_format(self, text):
         return "```" + text + "```"
 
 
-client = ModBot(perspective_key)
-client.run(discord_token)
+def main():
+    # Log to discord.log and the console from a background thread, sampling the gateway's DEBUG chatter
+    listener = setup_logging('discord.log')
+
+    # There should be a file called 'token.json' inside the same folder as this file
+    token_path = 'tokens.json'
+    if not os.path.isfile(token_path):
+        raise Exception(f"{token_path} not found!")
+    with open(token_path) as f:
+        # If you get an error here, it means your token is formatted incorrectly. Did you put it in quotes?
+        tokens = json.load(f)
+        discord_token = tokens['discord']
+        perspective_key = tokens['perspective']
+
+    client = ModBot(perspective_key)
+    try:
+        # Our handlers are already set up, so discord.py shouldn't add its own
+        client.run(discord_token, log_handler=None)
+    finally:
+        listener.stop()
+
+
+# Importing the module (e.g. from benchmark_load.py) doesn't log in or need tokens.json
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+# bulk_score.py
+'''
+Scores a CSV archive of messages (same columns as en_dup.csv: label, content, source, author, time)
+with the bot's classifier. Input is streamed in chunks and fanned out to a pool of worker processes,
+each loading the model once; predictions are appended to the output as they complete, so an
+interrupted run picks up where it stopped when started again with the same arguments.
+
+    python bulk_score.py archive.csv scores.csv --workers 4
+'''
+import argparse
+import csv
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+import numpy as np
+from backends import load_backend
+from normalize import load_vocabulary, normalize_text
+
+LABELS = ['F', 'T', 'U'] # Classifier codes 0, 1, 2
+OUTPUT_COLUMNS = ['row', 'label', 'prediction', 'prob_F', 'prob_T', 'prob_U']
+# simpletransformers starts its own process pool to predict, which pool workers (daemonic) can't do
+SCORED_BACKENDS = ['torch', 'quantized', 'onnx']
+
+# Set in each worker process by init_worker
+model = None
+vocabulary = frozenset()
+
+
+def init_worker(backend, model_dir, vocabulary_path, threads):
+    global model, vocabulary
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    model = load_backend(backend, model_dir)
+    if vocabulary_path:
+        vocabulary = load_vocabulary(vocabulary_path)
+
+
+def score_chunk(chunk):
+    # Same text the bot would classify for these messages
+    texts = [normalize_text(content, vocabulary).text for _, _, content in chunk]
+    predictions, raw_outputs = model.predict(texts)
+    raw_outputs = np.asarray(raw_outputs, dtype=np.float64)
+    probabilities = np.exp(raw_outputs - raw_outputs.max(axis=1, keepdims=True))
+    probabilities /= probabilities.sum(axis=1, keepdims=True)
+    return [[row, label, LABELS[int(p)]] + [f'{x:.4f}' for x in probs]
+            for (row, label, _), p, probs in zip(chunk, predictions, probabilities)]
+
+
+def read_chunks(path, chunk_size, skip):
+    with open(path, newline='', encoding='utf-8') as f:
+        rows = ((i, row.get('label') or '', row['content'] or '') for i, row in enumerate(csv.DictReader(f)))
+        rows = itertools.islice(rows, skip, None)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+
+def resume(path):
+    '''
+    Drops any partially written last line from a previous run and returns (whether the header has been
+    written, the rows already scored).
+    '''
+    if not os.path.isfile(path) or os.path.getsize(path) == 0:
+        return False, []
+    with open(path, 'rb+') as f:
+        data = f.read()
+        complete = data[:data.rfind(b'\n') + 1]
+        f.seek(len(complete))
+        f.truncate()
+    lines = complete.decode('utf-8').splitlines()
+    return bool(lines), list(csv.reader(lines[1:]))
+
+
+class Metrics:
+    def __init__(self):
+        self.confusion = np.zeros((len(LABELS), len(LABELS)), dtype=np.int64) # Rows are labels, columns predictions
+
+    def add(self, label, prediction):
+        if label in LABELS:
+            self.confusion[LABELS.index(label), LABELS.index(prediction)] += 1
+
+    def report(self):
+        total = self.confusion.sum()
+        if total == 0:
+            return
+        print(f'\naccuracy on {total} labelled rows: {np.trace(self.confusion) / total:.2%}')
+        print('confusion matrix (rows = label, columns = prediction):')
+        print('      ' + ''.join(f'{label:>8}' for label in LABELS))
+        for label, counts in zip(LABELS, self.confusion):
+            print(f'{label:>6}' + ''.join(f'{count:>8}' for count in counts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input')
+    parser.add_argument('output')
+    parser.add_argument('--model', default='checkpoint-3750-epoch-10')
+    parser.add_argument('--backend', default='torch', choices=SCORED_BACKENDS)
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument('--threads', type=int, default=2, help='torch threads per worker')
+    parser.add_argument('--chunk-size', type=int, default=256)
+    parser.add_argument('--vocabulary', default='../en_dup.csv', help="dataset whose words guide leetspeak folding, '' to disable")
+    args = parser.parse_args()
+
+    has_header, done = resume(args.output)
+    metrics = Metrics()
+    for _, label, prediction, *_ in done:
+        metrics.add(label, prediction)
+    if done:
+        print(f'resuming after {len(done)} already scored rows', file=sys.stderr)
+
+    vocabulary_path = args.vocabulary if args.vocabulary and os.path.isfile(args.vocabulary) else None
+    # spawn rather than fork, so workers don't inherit a half-initialised torch thread pool
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(args.workers, initializer=init_worker, initargs=(args.backend, args.model, vocabulary_path, args.threads)) as pool, \
+            open(args.output, 'a', newline='', encoding='utf-8') as out:
+        writer = csv.writer(out)
+        if not has_header:
+            writer.writerow(OUTPUT_COLUMNS)
+
+        start = time.perf_counter()
+        scored = 0
+        # Keep only a few chunks in flight so memory stays flat however large the input is
+        in_flight = deque()
+        chunks = read_chunks(args.input, args.chunk_size, len(done))
+        for chunk in itertools.chain(chunks, [None]):
+            if chunk is not None:
+                in_flight.append(pool.apply_async(score_chunk, (chunk,)))
+                if len(in_flight) < args.workers * 2:
+                    continue
+            while in_flight and (chunk is None or len(in_flight) >= args.workers * 2):
+                rows = in_flight.popleft().get()
+                writer.writerows(rows)
+                out.flush()
+                for _, label, prediction, *_ in rows:
+                    metrics.add(label, prediction)
+                scored += len(rows)
+                elapsed = time.perf_counter() - start
+                print(f'\r{len(done) + scored} rows scored, {scored / elapsed:.1f} rows/s', end='', file=sys.stderr)
+
+    print(file=sys.stderr)
+    metrics.report()
+
+
+if __name__ == '__main__':
+    main()
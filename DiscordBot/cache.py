@@ -0,0 +1,87 @@
+# cache.py
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+import metrics
+
+MAX_ENTRIES = 10000
+TTL_SECONDS = 24 * 60 * 60
+
+LOOKUPS = metrics.counter('modbot_verdict_cache_lookups_total', 'Verdict cache lookups, by whether the verdict was cached.', labelnames=('result',))
+
+
+class VerdictCache:
+    '''
+    Bounded LRU cache of verdicts (classifier outputs or Perspective scores) keyed on a hash of the
+    normalized text (the `key` from normalize.py) and the version of the model that produced them.
+    Entries expire after a TTL and the cache can optionally be saved to and restored from a local JSON file.
+    '''
+
+    def __init__(self, max_entries=MAX_ENTRIES, ttl=TTL_SECONDS, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.entries = OrderedDict() # Map from key to (expiry time, verdict), least recently used first
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.isfile(path):
+            self.load()
+
+    def key(self, version, text):
+        digest = hashlib.sha256()
+        digest.update(version.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(text.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, version, text):
+        '''
+        Returns the cached verdict for this text and model version, or None if there isn't a live one.
+        '''
+        key = self.key(version, text)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.time():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            LOOKUPS.inc(result='miss')
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        LOOKUPS.inc(result='hit')
+        return entry[1]
+
+    def put(self, version, text, verdict):
+        key = self.key(version, text)
+        self.entries[key] = (time.time() + self.ttl, verdict)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate()}
+
+    def load(self):
+        with open(self.path, encoding='utf-8') as f:
+            saved = json.load(f)
+        now = time.time()
+        for key, (expiry, verdict) in saved.items():
+            if expiry >= now:
+                self.entries[key] = (expiry, verdict)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        if not self.path:
+            return
+        # Write to a temporary file first so a crash mid-write can't corrupt the saved cache
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
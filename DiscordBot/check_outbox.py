@@ -0,0 +1,145 @@
+# check_outbox.py
+'''
+Quick checks of the Outbox against a stand-in channel that records what it is sent: merging stays
+within Discord's 2000-character limit, longer texts are split at the boundary, prompts sent alone
+jump the queue, a full channel drops its oldest forwards (and nothing else) and a failed send fails
+only its own texts. The pacing checks use the real rate limits and record when each send happens, so
+they take several seconds.
+Exits non-zero on the first failed check.
+
+    python check_outbox.py
+'''
+import asyncio
+import logging
+import time
+from dispatcher import Outbox, MESSAGE_LIMIT, CHANNEL_RATE, GLOBAL_RATE
+
+FAST = (1000, 1.0) # Rate limits loose enough that the checks don't wait on the rate limiters
+
+
+class RecordingChannel:
+    def __init__(self, channel_id=1, fail_on=None):
+        self.id = channel_id
+        self.fail_on = fail_on # Sends containing this text raise
+        self.sent = []
+        self.times = [] # time.monotonic() of each send
+
+    async def send(self, text):
+        self.times.append(time.monotonic())
+        if self.fail_on is not None and self.fail_on in text:
+            raise ConnectionError('send failed')
+        self.sent.append(text)
+        return len(self.sent) # Stands in for the discord.Message
+
+
+def busiest_window(times, per):
+    '''
+    Most sends that fell within any per-second window.
+    '''
+    times = sorted(times)
+    # A hair of slack for the clock reads between the rate limiter and the channel
+    return max(sum(1 for t in times[i:] if t < start + per - 0.01) for i, start in enumerate(times))
+
+
+async def check_merging():
+    outbox = Outbox(FAST, FAST)
+    channel = RecordingChannel()
+    futures = [outbox.send(channel, 'x' * 600) for _ in range(5)]
+    await outbox.drain()
+    assert all(len(text) <= MESSAGE_LIMIT for text in channel.sent), [len(text) for text in channel.sent]
+    # 3 x 600 plus two joining newlines fits, a fourth doesn't
+    assert [len(text) for text in channel.sent] == [1802, 1201], [len(text) for text in channel.sent]
+    assert [f.result() for f in futures] == [1, 1, 1, 2, 2]
+    assert outbox.merged == 3
+
+
+async def check_boundary():
+    outbox = Outbox(FAST, FAST)
+    channel = RecordingChannel()
+    exact = outbox.send(channel, 'a' * MESSAGE_LIMIT)
+    over = outbox.send(channel, 'b' * (MESSAGE_LIMIT + 1), alone=True)
+    lines = outbox.send(channel, ('c' * 99 + '\n') * 30, alone=True)
+    await outbox.drain()
+    assert [len(text) for text in channel.sent] == [2000, 1, 1999, 1000, 2000], [len(text) for text in channel.sent]
+    # Exactly at the limit goes out whole; one over is cut there; lines are split at the last break that fits
+    assert channel.sent[4] == 'a' * MESSAGE_LIMIT
+    assert channel.sent[0] == 'b' * MESSAGE_LIMIT and channel.sent[1] == 'b'
+    assert channel.sent[2].endswith('c' * 99) and channel.sent[3].startswith('c' * 99)
+    # Each future resolves to the last piece of its text
+    assert (over.result(), lines.result(), exact.result()) == (2, 4, 5)
+
+
+async def check_priority():
+    outbox = Outbox(FAST, FAST)
+    channel = RecordingChannel()
+    for i in range(3):
+        outbox.send(channel, f'note {i}')
+    prompt = outbox.send(channel, 'NEW REPORT #1', alone=True)
+    await outbox.drain()
+    assert channel.sent[0] == 'NEW REPORT #1', channel.sent
+    assert channel.sent[1] == 'note 0\nnote 1\nnote 2', channel.sent
+    assert prompt.result() == 1
+
+
+async def check_bounded():
+    outbox = Outbox(FAST, FAST, max_queued=3)
+    channel = RecordingChannel()
+    reply = outbox.send(channel, 'This post has been deleted.')
+    futures = [outbox.send(channel, f'forward {i}', droppable=True) for i in range(5)]
+    hint = outbox.send(channel, 'Report #1: please enter `yes` or `no`.')
+    await outbox.drain()
+    # Only the oldest forwards are dropped; moderator replies around them all go out
+    assert channel.sent == ['This post has been deleted.\nforward 2\nforward 3\nforward 4\nReport #1: please enter `yes` or `no`.'], channel.sent
+    assert isinstance(futures[0].exception(), OverflowError) and outbox.dropped == 2
+    assert reply.result() == hint.result() == 1
+
+
+async def check_channel_pacing():
+    # The real per-channel limit: a burst of its capacity, then no more until that window has passed
+    capacity, per = CHANNEL_RATE
+    outbox = Outbox()
+    channel = RecordingChannel()
+    for i in range(capacity + 5):
+        outbox.send(channel, f'prompt {i}', alone=True)
+    await outbox.drain(timeout=3 * per)
+    assert len(channel.times) == capacity + 5, len(channel.times)
+    assert busiest_window(channel.times, per) <= capacity, busiest_window(channel.times, per)
+    assert channel.times[capacity - 1] - channel.times[0] < 0.1 # The first burst isn't held back
+    assert channel.times[capacity] - channel.times[0] >= per - 0.01, channel.times[capacity] - channel.times[0]
+
+
+async def check_global_pacing():
+    # Many quiet channels at once are held to the real global limit instead
+    capacity, per = GLOBAL_RATE
+    outbox = Outbox()
+    channels = [RecordingChannel(channel_id) for channel_id in range(capacity // 2)]
+    for channel in channels:
+        for i in range(4):
+            outbox.send(channel, f'prompt {i}', alone=True)
+    await outbox.drain(timeout=10 * per)
+    times = [t for channel in channels for t in channel.times]
+    assert len(times) == len(channels) * 4, len(times)
+    assert busiest_window(times, per) <= capacity, busiest_window(times, per)
+
+
+async def check_failure():
+    outbox = Outbox(FAST, FAST)
+    channel = RecordingChannel(fail_on='bad')
+    bad = outbox.send(channel, 'bad', alone=True)
+    good = outbox.send(channel, 'good', alone=True)
+    await outbox.drain()
+    assert isinstance(bad.exception(), ConnectionError)
+    assert good.result() == 1 and channel.sent == ['good']
+
+
+def main():
+    # The drops and the failed send below are on purpose, their log lines would only be noise
+    logging.getLogger('discord').setLevel(logging.CRITICAL)
+    for check in [check_merging, check_boundary, check_priority, check_bounded, check_channel_pacing, check_global_pacing,
+                  check_failure]:
+        asyncio.run(check())
+        print(f'{check.__name__}: ok')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+# check_perspective.py
+'''
+Quick checks of PerspectiveClient against a stub of the Perspective API on localhost: throttling with
+Retry-After (honoured, and clamped when it's unreasonable), server errors retried with backoff, slow
+responses timing out, and identical texts asked for at the same time sharing one request, even when
+the caller that started it is cancelled. Exits non-zero on the first failed check.
+
+    python check_perspective.py
+'''
+import asyncio
+import json
+import time
+from collections import Counter
+from aiohttp import web
+import perspective
+from perspective import PerspectiveClient, PerspectiveError
+
+SCORES = {'attributeScores': {'TOXICITY': {'summaryScore': {'value': 0.25}}}}
+
+
+class Stub:
+    '''
+    Answers by the text being scored: 'throttled <seconds>' gets one 429 with that Retry-After,
+    'broken <n>' gets n 503s, 'slow' takes longer than any client timeout here, and anything else is
+    scored after a short delay. Counts the requests for each text.
+    '''
+
+    def __init__(self):
+        self.requests = Counter()
+        self.runner = None
+        self.url = None
+
+    async def handle(self, request):
+        text = json.loads(await request.text())['comment']['text']
+        self.requests[text] += 1
+        kind, _, arg = text.partition(' ')
+        if kind == 'throttled' and self.requests[text] == 1:
+            return web.Response(status=429, headers={'Retry-After': arg})
+        if kind == 'broken' and self.requests[text] <= int(arg):
+            return web.Response(status=503)
+        await asyncio.sleep(1 if kind == 'slow' else 0.2)
+        return web.json_response(SCORES)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/analyze', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', 0).start()
+        self.url = f'http://127.0.0.1:{self.runner.addresses[0][1]}/analyze'
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+async def check(name, run, **options):
+    stub = Stub()
+    await stub.start()
+    client = PerspectiveClient('check', url=stub.url, **options)
+    try:
+        await run(client, stub)
+    finally:
+        await client.close()
+        await stub.stop()
+    print(f'{name}: ok')
+
+
+async def throttled(client, stub):
+    start = time.perf_counter()
+    assert await client.score('throttled 0.5') == {'TOXICITY': 0.25}
+    elapsed = time.perf_counter() - start
+    assert stub.requests['throttled 0.5'] == 2 and 0.5 <= elapsed < 1.5, (stub.requests, elapsed)
+    # An unreasonable Retry-After is clamped to MAX_RETRY_AFTER
+    start = time.perf_counter()
+    assert await client.score('throttled 3600') == {'TOXICITY': 0.25}
+    elapsed = time.perf_counter() - start
+    assert perspective.MAX_RETRY_AFTER <= elapsed < perspective.MAX_RETRY_AFTER + 1, elapsed
+
+
+async def broken(client, stub):
+    assert await client.score('broken 2') == {'TOXICITY': 0.25}
+    assert stub.requests['broken 2'] == 3, stub.requests
+    # Out of retries: the last 503 is reported rather than retried
+    try:
+        await client.score('broken 5')
+    except PerspectiveError as e:
+        assert '503' in str(e), e
+    else:
+        raise AssertionError('expected a PerspectiveError')
+    assert stub.requests['broken 5'] == client.retries + 1, stub.requests
+
+
+async def slow(client, stub):
+    start = time.perf_counter()
+    try:
+        await client.score('slow')
+    except PerspectiveError:
+        pass
+    else:
+        raise AssertionError('expected a PerspectiveError')
+    assert stub.requests['slow'] == client.retries + 1, stub.requests
+    assert time.perf_counter() - start < 2, time.perf_counter() - start
+
+
+async def coalesced(client, stub):
+    results = await asyncio.gather(*(client.score('same text') for _ in range(10)))
+    assert results == [{'TOXICITY': 0.25}] * 10 and stub.requests['same text'] == 1, stub.requests
+    # Cancelling the caller that started the request doesn't cancel it for the others
+    first = asyncio.get_running_loop().create_task(client.score('cancelled'))
+    await asyncio.sleep(0.05)
+    second = asyncio.get_running_loop().create_task(client.score('cancelled'))
+    await asyncio.sleep(0.05)
+    first.cancel()
+    assert await second == {'TOXICITY': 0.25} and stub.requests['cancelled'] == 1, stub.requests
+    assert not client.inflight
+
+
+async def main():
+    # Short backoff and timeouts so the checks run in seconds; MAX_RETRY_AFTER is the real one
+    await check('429 with Retry-After', throttled, backoff=0.05)
+    await check('503 retried', broken, backoff=0.05, retries=3)
+    await check('slow response', slow, backoff=0.05, retries=1, timeout=0.3)
+    await check('identical texts coalesced', coalesced)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
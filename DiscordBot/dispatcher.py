@@ -0,0 +1,202 @@
+# dispatcher.py
+import asyncio
+import logging
+import time
+from collections import deque
+import metrics
+
+MESSAGE_LIMIT = 2000 # Discord's maximum message length
+CHANNEL_RATE = (5, 5.0) # Discord allows about 5 messages per 5 seconds in a channel
+GLOBAL_RATE = (50, 1.0) # ...and about 50 requests per second overall
+MAX_QUEUED = 200 # Droppable texts waiting per channel before the oldest of them are dropped
+PRUNE_INTERVAL = 300 # Seconds between sweeps for idle channels' rate limiters
+
+logger = logging.getLogger('discord')
+
+SEND_SECONDS = metrics.histogram('modbot_channel_send_seconds', 'Time for each channel.send call, after rate limiting.')
+
+
+class RateLimiter:
+    '''
+    Allows at most capacity sends in any window of per seconds, the way Discord counts them. (A token
+    bucket refilling at capacity/per would let a full burst plus the refill through in one window.)
+    '''
+
+    def __init__(self, capacity, per):
+        self.capacity = capacity
+        self.per = per
+        self.sent = deque() # monotonic times of the sends in the current window, oldest first
+
+    def idle(self, now):
+        '''
+        True once the last send has left the window, so dropping the limiter loses nothing.
+        '''
+        return not self.sent or now - self.sent[-1] >= self.per
+
+    def wait(self, now):
+        while self.sent and now - self.sent[0] >= self.per:
+            self.sent.popleft()
+        return 0 if len(self.sent) < self.capacity else self.sent[0] + self.per - now
+
+
+async def acquire(*limiters):
+    '''
+    Waits until every limiter has room, then counts one send against all of them at the same moment, so
+    time spent waiting on one limiter isn't counted against the others.
+    '''
+    while True:
+        now = time.monotonic()
+        delay = max(limiter.wait(now) for limiter in limiters)
+        if delay <= 0:
+            for limiter in limiters:
+                limiter.sent.append(now)
+            return
+        await asyncio.sleep(delay)
+
+
+class Outbox:
+    '''
+    Outbound message scheduler. Each channel gets its own queue, drained by a worker that merges
+    consecutive texts up to Discord's 2000-character limit and paces sends with rate limiters, so
+    handlers can queue a message and carry on instead of waiting behind the channel's rate limit.
+    Texts sent alone (moderation prompts) go in a separate lane that is always drained first. Only
+    texts queued as droppable (the bulk forwards of channel posts) are ever dropped when a channel
+    can't keep up; replies to moderators always go out.
+    '''
+
+    def __init__(self, channel_rate=CHANNEL_RATE, global_rate=GLOBAL_RATE, limit=MESSAGE_LIMIT, max_queued=MAX_QUEUED):
+        self.channel_rate = channel_rate
+        self.limit = limit
+        self.max_queued = max_queued
+        self.global_limiter = RateLimiter(*global_rate)
+        # Map from channel id to (alone deque, merged deque, droppable deque). The first two hold
+        # (text, future) entries; the third holds the merged lane's droppable entries, oldest first
+        self.queues = {}
+        self.limiters = {} # Map from channel id to that channel's rate limiter
+        self.workers = {} # Map from channel id to the task draining its queue
+        self.pruned = time.monotonic()
+        self.queued = 0
+        self.sent = 0 # Discord messages actually sent
+        self.merged = 0 # Texts that rode along in another text's message
+        self.dropped = 0 # Droppable texts dropped because their channel had too many waiting
+
+    def split(self, text):
+        '''
+        Cuts text into pieces of at most limit characters, at a line break where there is one.
+        '''
+        chunks = []
+        while len(text) > self.limit:
+            cut = text.rfind('\n', 0, self.limit + 1)
+            if cut <= 0:
+                cut = self.limit
+            chunks.append(text[:cut])
+            text = text[cut:].lstrip('\n')
+        chunks.append(text)
+        return chunks
+
+    def send(self, channel, text, alone=False, droppable=False):
+        '''
+        Queues text for the channel and returns a future for the discord.Message it ends up in (the
+        last one, if it's too long for a single message and gets split). Pass alone=True when the
+        message must not be merged with others (e.g. when its id is needed); those are sent first.
+        Pass droppable=True for texts it's acceptable to lose when the channel falls behind.
+        '''
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        alone_lane, merged_lane, droppables = self.queues.setdefault(channel.id, (deque(), deque(), deque()))
+        lane = alone_lane if alone else merged_lane
+        chunks = self.split(text)
+        # Only the last piece resolves the future
+        entries = [(chunk, None) for chunk in chunks[:-1]] + [(chunks[-1], future)]
+        lane.extend(entries)
+        if droppable and not alone:
+            droppables.extend(entries)
+        self.queued += 1
+        while len(droppables) > self.max_queued:
+            # A channel we can't keep up with: the oldest forwards are the least useful
+            entry = droppables.popleft()
+            # By identity: another text's entry can compare equal to this one
+            del merged_lane[next(i for i, queued in enumerate(merged_lane) if queued is entry)]
+            dropped = entry[1]
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                logger.warning('outbox for channel %s is full, %d texts dropped so far', channel.id, self.dropped)
+            if dropped is not None and not dropped.done():
+                dropped.set_exception(OverflowError(f'outbox for channel {channel.id} is full'))
+                dropped.exception()
+        worker = self.workers.get(channel.id)
+        if worker is None or worker.done():
+            self.prune()
+            self.workers[channel.id] = loop.create_task(self.drain_channel(channel))
+        return future
+
+    def prune(self):
+        '''
+        Forgets the rate limiters of channels with nothing queued that have been quiet for a whole window,
+        so the map doesn't grow with every channel we ever sent to.
+        '''
+        now = time.monotonic()
+        if now - self.pruned < PRUNE_INTERVAL:
+            return
+        self.pruned = now
+        for channel_id in [c for c, limiter in self.limiters.items() if c not in self.queues and limiter.idle(now)]:
+            del self.limiters[channel_id]
+
+    def take_batch(self, lanes):
+        alone, pending, droppables = lanes
+        if alone:
+            text, future = alone.popleft()
+            return text, [future]
+        entry = pending.popleft()
+        if droppables and droppables[0] is entry:
+            droppables.popleft()
+        text, future = entry
+        texts, futures = [text], [future]
+        length = len(text)
+        while pending and length + 1 + len(pending[0][0]) <= self.limit:
+            entry = pending.popleft()
+            if droppables and droppables[0] is entry:
+                droppables.popleft()
+            text, future = entry
+            texts.append(text)
+            futures.append(future)
+            length += 1 + len(text)
+        return "\n".join(texts), futures
+
+    async def drain_channel(self, channel):
+        lanes = self.queues[channel.id]
+        limiter = self.limiters.setdefault(channel.id, RateLimiter(*self.channel_rate))
+        while lanes[0] or lanes[1]:
+            # Wait for a send slot first, so texts queued in the meantime can still be merged in
+            await acquire(limiter, self.global_limiter)
+            text, futures = self.take_batch(lanes)
+            futures = [future for future in futures if future is not None]
+            try:
+                with SEND_SECONDS.time():
+                    message = await channel.send(text)
+            except Exception as e:
+                logger.exception('failed to send to channel %s', channel.id)
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                        # Mark it retrieved, most callers never await the future
+                        future.exception()
+                continue
+            self.sent += 1
+            self.merged += max(len(futures) - 1, 0)
+            for future in futures:
+                if not future.done():
+                    future.set_result(message)
+        self.workers.pop(channel.id, None)
+        del self.queues[channel.id]
+
+    def depth(self):
+        return sum(len(alone) + len(pending) for alone, pending, _ in self.queues.values())
+
+    async def drain(self, timeout=10):
+        '''
+        Waits (up to timeout seconds) for everything queued so far to be sent.
+        '''
+        workers = [worker for worker in self.workers.values() if not worker.done()]
+        if workers:
+            await asyncio.wait(workers, timeout=timeout)
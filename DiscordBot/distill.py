@@ -0,0 +1,298 @@
+# distill.py
+'''
+Trains a small student classifier to imitate checkpoint-3750-epoch-10 on a CPU-only machine, then
+compares the two on held-out messages: accuracy, flag recall, per-message latency and size.
+
+The student is the teacher with most of its transformer layers dropped. The layers that are kept,
+the embeddings and the classification head start from the teacher's weights. It is trained on the
+labelled rows of en_dup.csv against a mix of the F/T/U labels and the teacher's softened predictions.
+Validation and test rows are drawn only from rows the teacher never trained on (it was fine-tuned on
+the first 1000 rows, see CS152_Classifier.ipynb), and exact repeats of those rows are left out too, so
+the comparison doesn't flatter the teacher.
+Tokenized inputs and teacher logits are cached in cache_dir/, so reruns with other student settings
+skip the slow part. The student is saved as a regular checkpoint folder, so every backend in
+backends.py (and the bot, through MODEL_NAME) can load it.
+
+    python distill.py --teacher checkpoint-3750-epoch-10 --out student-3l --layers 3
+'''
+import argparse
+import copy
+import csv
+import hashlib
+import io
+import math
+import os
+import random
+import re
+import time
+import numpy as np
+from backends import load_backend, MAX_SEQ_LENGTH
+from benchmark_backends import run
+from duplicates import LABEL_CODES
+from normalize import normalize_text
+from prefilter import load_rows, FLAGGED
+
+CACHE_DIR = 'cache_dir' # Where simpletransformers caches its features too
+SEED = 152 # Same split seed as prefilter.py
+TEACHER_ROWS = 1000 # The notebook fine-tuned the teacher on df.head(1000)
+
+
+def digest(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()[:16]
+
+
+def teacher_seen(path, texts, teacher_rows=TEACHER_ROWS):
+    '''
+    For each row load_rows returns, whether the teacher trained on it or on the exact same text.
+    '''
+    with open(path, newline='', encoding='utf-8') as f:
+        positions = [i for i, row in enumerate(csv.DictReader(f)) if row['label'] in LABEL_CODES and row['content']]
+    seen_keys = {normalize_text(text).key for text, position in zip(texts, positions) if position < teacher_rows}
+    return [normalize_text(text).key in seen_keys for text in texts]
+
+
+def split(labels, seen):
+    '''
+    Stratified train/validation/test split of row indices, the same on every run. Validation and test are
+    10% of the rows each, taken only from rows the teacher hasn't seen; everything else is for training.
+    '''
+    from sklearn.model_selection import train_test_split
+    unseen = np.array([i for i in range(len(labels)) if not seen[i]])
+    held_out = min(0.2 * len(labels) / len(unseen), 0.5)
+    train, rest = train_test_split(unseen, test_size=held_out, stratify=[labels[i] for i in unseen], random_state=SEED)
+    validation, test = train_test_split(rest, test_size=0.5, stratify=[labels[i] for i in rest], random_state=SEED)
+    train = np.sort(np.concatenate([train, [i for i in range(len(labels)) if seen[i]]]).astype(int))
+    return train, validation, test
+
+
+def tokenize(tokenizer, texts, key):
+    '''
+    Token ids for every text, cached as one flat array plus offsets.
+    '''
+    path = os.path.join(CACHE_DIR, f'tokens-{key}.npz')
+    if os.path.isfile(path):
+        with np.load(path) as saved:
+            ids, offsets = saved['ids'], saved['offsets']
+    else:
+        encoded = tokenizer(list(texts), truncation=True, max_length=MAX_SEQ_LENGTH)['input_ids']
+        ids = np.concatenate([np.asarray(row, dtype=np.int32) for row in encoded])
+        offsets = np.cumsum([0] + [len(row) for row in encoded])
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        np.savez(path, ids=ids, offsets=offsets)
+    return [ids[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def teacher_logits(teacher_dir, texts, key):
+    path = os.path.join(CACHE_DIR, f'teacher-{key}.npy')
+    if os.path.isfile(path):
+        return np.load(path)
+    teacher = load_backend('torch', teacher_dir, batch_size=32)
+    logits = []
+    start = time.perf_counter()
+    for i in range(0, len(texts), 256):
+        logits.extend(teacher.predict(texts[i:i + 256])[1])
+        print(f'\rteacher logits for {len(logits)}/{len(texts)} rows, {time.perf_counter() - start:.0f}s', end='')
+    print()
+    logits = np.array(logits, dtype=np.float32)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    np.save(path, logits)
+    return logits
+
+
+def build_student(teacher_dir, layers):
+    '''
+    Copy of the teacher keeping `layers` of its transformer layers, spread evenly over its depth
+    (the first and last are always kept). Returns the student and the teacher layers it kept.
+    '''
+    from transformers import AutoModelForSequenceClassification
+    teacher = AutoModelForSequenceClassification.from_pretrained(teacher_dir)
+    config = copy.deepcopy(teacher.config)
+    config.num_hidden_layers = layers
+    student = AutoModelForSequenceClassification.from_config(config)
+
+    keep = [int(i) for i in np.linspace(0, teacher.config.num_hidden_layers - 1, layers).round()]
+    layer_name = re.compile(rf'^({teacher.base_model_prefix}\.encoder\.layer\.)(\d+)(\..*)$')
+    state = {}
+    for name, value in teacher.state_dict().items():
+        m = layer_name.match(name)
+        if m is None:
+            state[name] = value
+        elif int(m.group(2)) in keep:
+            state[m.group(1) + str(keep.index(int(m.group(2)))) + m.group(3)] = value
+    student.load_state_dict(state)
+    return student, keep
+
+
+def batches(sequences, indices, batch_size, pad_id, shuffle=False):
+    # Texts of similar length go together so batches carry little padding; the batch order is shuffled instead
+    order = sorted(indices, key=lambda i: len(sequences[i]))
+    chunks = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+    if shuffle:
+        random.shuffle(chunks)
+    for chunk in chunks:
+        length = max(len(sequences[i]) for i in chunk)
+        ids = np.full((len(chunk), length), pad_id, dtype=np.int64)
+        mask = np.zeros((len(chunk), length), dtype=np.int64)
+        for row, i in enumerate(chunk):
+            ids[row, :len(sequences[i])] = sequences[i]
+            mask[row, :len(sequences[i])] = 1
+        yield chunk, ids, mask
+
+
+def evaluate(student, sequences, labels, indices, pad_id):
+    import torch
+    student.eval()
+    correct = 0
+    with torch.no_grad():
+        for chunk, ids, mask in batches(sequences, indices, 64, pad_id):
+            logits = student(input_ids=torch.from_numpy(ids), attention_mask=torch.from_numpy(mask)).logits
+            correct += sum(int(p == labels[i]) for p, i in zip(logits.argmax(dim=-1).tolist(), chunk))
+    return correct / len(indices)
+
+
+def distill(student, sequences, labels, soft_targets, train, validation, pad_id, args):
+    '''
+    Trains the student on alpha * (KL to the teacher at temperature T) + (1 - alpha) * (cross-entropy
+    to the labels), keeping the weights from the epoch with the best validation accuracy.
+    '''
+    import torch
+    import torch.nn.functional as F
+    from transformers import get_linear_schedule_with_warmup
+    labels = torch.tensor(labels)
+    soft_targets = torch.from_numpy(soft_targets)
+    optimizer = torch.optim.AdamW(student.parameters(), lr=args.lr, weight_decay=0.01)
+    steps = args.epochs * math.ceil(len(train) / args.batch_size)
+    scheduler = get_linear_schedule_with_warmup(optimizer, int(0.06 * steps), steps)
+    t = args.temperature
+
+    best_accuracy, best_state = -1.0, None
+    for epoch in range(args.epochs):
+        student.train()
+        start = time.perf_counter()
+        total_loss = 0.0
+        for chunk, ids, mask in batches(sequences, train, args.batch_size, pad_id, shuffle=True):
+            index = torch.tensor(chunk)
+            logits = student(input_ids=torch.from_numpy(ids), attention_mask=torch.from_numpy(mask)).logits
+            # Scaled by T^2 so the soft loss's gradients stay comparable to the label loss's as T changes
+            soft_loss = F.kl_div(F.log_softmax(logits / t, dim=-1), F.softmax(soft_targets[index] / t, dim=-1),
+                                 reduction='batchmean') * t * t
+            hard_loss = F.cross_entropy(logits, labels[index])
+            loss = args.alpha * soft_loss + (1 - args.alpha) * hard_loss
+            optimizer.zero_grad()
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(student.parameters(), 1.0)
+            optimizer.step()
+            scheduler.step()
+            total_loss += loss.item() * len(chunk)
+
+        accuracy = evaluate(student, sequences, labels.tolist(), validation, pad_id)
+        print(f'epoch {epoch + 1}/{args.epochs}: loss {total_loss / len(train):.4f}, '
+              f'validation accuracy {accuracy:.2%}, {time.perf_counter() - start:.0f}s')
+        if accuracy > best_accuracy:
+            best_accuracy, best_state = accuracy, copy.deepcopy(student.state_dict())
+    student.load_state_dict(best_state)
+    return best_accuracy
+
+
+def serialized_size(model):
+    # Size of the weights as torch.save writes them, comparable between plain and quantized models
+    import torch
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def compare(candidates, texts, labels, batch_size):
+    '''
+    Runs each (name, model dir, backend) on the test texts and returns a markdown table comparing them.
+    '''
+    from sklearn.metrics import f1_score
+    labels = np.array(labels)
+    flagged = np.isin(labels, FLAGGED)
+    rows = []
+    teacher_predictions = None
+    for name, model_dir, backend_name in candidates:
+        backend = load_backend(backend_name, model_dir)
+        predictions, _, latencies, throughput = run(backend, texts, batch_size)
+        if teacher_predictions is None:
+            teacher_predictions = predictions
+        p50, p95 = np.percentile(latencies, [50, 95]) * 1000
+        rows.append([
+            name,
+            f'{np.mean(predictions == labels):.2%}',
+            f"{f1_score(labels, predictions, average='macro'):.3f}",
+            f'{np.mean(np.isin(predictions[flagged], FLAGGED)):.2%}',
+            f'{np.mean(predictions == teacher_predictions):.2%}',
+            f'{p50:.1f}', f'{p95:.1f}', f'{throughput:.1f}',
+            f'{serialized_size(backend.model) / 2 ** 20:.0f}',
+        ])
+    header = ['model', 'accuracy', 'macro F1', 'flag recall', 'agrees with teacher', 'p50 ms', 'p95 ms', 'msg/s', 'size MB']
+    lines = ['| ' + ' | '.join(header) + ' |', '|' + '---|' * len(header)]
+    lines += ['| ' + ' | '.join(row) + ' |' for row in rows]
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--teacher', default='checkpoint-3750-epoch-10')
+    parser.add_argument('--data', default='../en_dup.csv')
+    parser.add_argument('--out', default='student')
+    parser.add_argument('--layers', type=int, default=3, help='transformer layers the student keeps')
+    parser.add_argument('--epochs', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--lr', type=float, default=5e-5)
+    parser.add_argument('--temperature', type=float, default=2.0)
+    parser.add_argument('--alpha', type=float, default=0.7, help='weight of the teacher loss against the label loss')
+    parser.add_argument('--threads', type=int, default=os.cpu_count(), help='torch threads')
+    parser.add_argument('--teacher-rows', type=int, default=TEACHER_ROWS, help='leading rows of --data the teacher was fine-tuned on')
+    args = parser.parse_args()
+
+    import torch
+    from transformers import AutoTokenizer
+    random.seed(SEED)
+    torch.manual_seed(SEED)
+    torch.set_num_threads(args.threads)
+
+    texts, labels = load_rows(args.data)
+    seen = teacher_seen(args.data, texts, args.teacher_rows)
+    train, validation, test = split(labels, seen)
+    counts = {label: labels.count(code) for label, code in LABEL_CODES.items()}
+    print(f'{len(texts)} labelled rows {counts}, {sum(seen)} seen by the teacher: '
+          f'{len(train)} train, {len(validation)} validation, {len(test)} test')
+
+    with open(args.data, 'rb') as f:
+        data_key = digest(f.read())
+    tokenizer = AutoTokenizer.from_pretrained(args.teacher)
+    sequences = tokenize(tokenizer, texts, digest(data_key, os.path.abspath(args.teacher), MAX_SEQ_LENGTH))
+    soft_targets = teacher_logits(args.teacher, texts, digest(data_key, os.path.abspath(args.teacher), MAX_SEQ_LENGTH))
+
+    student, kept = build_student(args.teacher, args.layers)
+    print(f'student keeps teacher layers {kept}')
+    start = time.perf_counter()
+    accuracy = distill(student, sequences, labels, soft_targets, train, validation, tokenizer.pad_token_id, args)
+    print(f'trained in {(time.perf_counter() - start) / 60:.1f} min, best validation accuracy {accuracy:.2%}')
+    student.save_pretrained(args.out)
+    tokenizer.save_pretrained(args.out)
+
+    test_texts = [texts[i] for i in test]
+    test_labels = [labels[i] for i in test]
+    table = compare([
+        ('teacher', args.teacher, 'torch'),
+        ('teacher int8', args.teacher, 'quantized'),
+        (f'student {args.layers}L', args.out, 'torch'),
+        (f'student {args.layers}L int8', args.out, 'quantized'),
+    ], test_texts, test_labels, batch_size=8)
+    report = (f'# Distillation report\n\n{len(test_texts)} held-out messages from {args.data}, none seen by the teacher; teacher {args.teacher}, '
+              f'student with teacher layers {kept}, T={args.temperature}, alpha={args.alpha}, {args.epochs} epochs. '
+              f'Latency is one message at a time, msg/s is batches of 8, on {args.threads} threads.\n\n{table}\n')
+    with open(os.path.join(args.out, 'distill_report.md'), 'w', encoding='utf-8') as f:
+        f.write(report)
+    print('\n' + report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+# duplicates.py
+import csv
+import hashlib
+import itertools
+import random
+import re
+import struct
+import time
+from collections import OrderedDict, deque
+from normalize import normalize_text
+
+NUM_PERM = 64
+BANDS = 16 # BANDS * ROWS must equal NUM_PERM
+ROWS = 4
+THRESHOLD = 0.7 # Estimated Jaccard similarity needed to count as a near-duplicate
+SHINGLE_SIZE = 3
+MAX_RECENT = 5000
+MAX_CLUSTER_MESSAGES = 100 # Posts per guild a cluster remembers, for applying the moderator's decision to
+DECISION_TTL = 24 * 60 * 60 # Seconds a moderator's decision keeps applying to new near-duplicates
+LABEL_CODES = {'F': 0, 'T': 1, 'U': 2} # Same codes the classifier was trained with (pd.Categorical)
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+
+class Cluster:
+    '''
+    A group of near-identical messages that share one classifier verdict. Moderator decisions, the
+    pending report and the matched posts are kept per guild, since each guild moderates on its own.
+    '''
+    ids = itertools.count(1)
+
+    def __init__(self, verdict=None, known=False):
+        self.id = next(Cluster.ids)
+        self.verdict = verdict # Classifier prediction shared by every message in the cluster
+        self.confidence = 1.0 # Classifier's flag probability, known claims are certain
+        self.known = known # True if the cluster was seeded from the labelled dataset
+        self.messages = {} # Map from guild id to the most recent posts in that guild that matched this cluster
+        self.reports = {} # Map from guild id to the pending auto report covering this cluster there
+        self.decisions = {} # Map from guild id to (answer, time) once a report has been reviewed there
+
+    def add_message(self, guild_id, message):
+        self.messages.setdefault(guild_id, deque(maxlen=MAX_CLUSTER_MESSAGES)).append(message)
+
+    def take_messages(self, guild_id):
+        return list(self.messages.pop(guild_id, ()))
+
+    def decide(self, guild_id, answer):
+        self.reports.pop(guild_id, None)
+        # A known false claim stays flagged even if one post of it was let through
+        if not (self.known and answer != 'yes'):
+            self.decisions[guild_id] = (answer, time.time())
+
+    def decision(self, guild_id):
+        '''
+        The guild's moderators' answer for this cluster, or None if they haven't ruled on it recently.
+        '''
+        answer, decided = self.decisions.get(guild_id, (None, 0))
+        if answer is not None and time.time() - decided > DECISION_TTL:
+            del self.decisions[guild_id]
+            return None
+        return answer
+
+
+class DuplicateIndex:
+    '''
+    MinHash/LSH index over recent channel messages, which expects texts already normalized (the `key`
+    from normalize.py). Each text is reduced to a MinHash signature of its
+    word shingles; the signature is split into bands and texts sharing any band bucket become candidates,
+    so lookups only compare against a handful of entries instead of the whole history.
+    '''
+
+    def __init__(self, max_recent=MAX_RECENT, threshold=THRESHOLD, seed=152):
+        rng = random.Random(seed)
+        self.perms = [(rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME)) for _ in range(NUM_PERM)]
+        self.threshold = threshold
+        self.max_recent = max_recent
+        self.buckets = [{} for _ in range(BANDS)] # Per band, map from band hash to the entry ids in that bucket
+        self.entries = {} # Map from entry id to (signature, cluster)
+        self.recent = OrderedDict() # Entry ids of channel messages, oldest first; seeded entries are never evicted
+        self.next_id = 0
+
+    def shingles(self, text):
+        words = re.findall(r'\w+', text)
+        if len(words) < SHINGLE_SIZE:
+            return {' '.join(words)}
+        return {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+    def signature(self, text):
+        hashes = [struct.unpack('<I', hashlib.blake2b(s.encode('utf-8'), digest_size=4).digest())[0] for s in self.shingles(text)]
+        return tuple(min(((a * h + b) % MERSENNE_PRIME) & MAX_HASH for h in hashes) for a, b in self.perms)
+
+    def bands(self, signature):
+        return [hash(signature[i * ROWS:(i + 1) * ROWS]) for i in range(BANDS)]
+
+    def similarity(self, sig1, sig2):
+        return sum(1 for x, y in zip(sig1, sig2) if x == y) / NUM_PERM
+
+    def query(self, text, signature=None):
+        '''
+        Returns the cluster of the most similar indexed text above the threshold, or None.
+        '''
+        if signature is None:
+            signature = self.signature(text)
+        candidates = set()
+        for band, key in enumerate(self.bands(signature)):
+            candidates.update(self.buckets[band].get(key, ()))
+
+        best, best_score = None, self.threshold
+        for entry_id in candidates:
+            other, cluster = self.entries[entry_id]
+            score = self.similarity(signature, other)
+            if score >= best_score:
+                best, best_score = cluster, score
+        return best
+
+    def add(self, text, cluster, signature=None, pinned=False):
+        if signature is None:
+            signature = self.signature(text)
+        entry_id = self.next_id
+        self.next_id += 1
+        self.entries[entry_id] = (signature, cluster)
+        for band, key in enumerate(self.bands(signature)):
+            self.buckets[band].setdefault(key, set()).add(entry_id)
+
+        if not pinned:
+            self.recent[entry_id] = None
+            while len(self.recent) > self.max_recent:
+                self.remove(self.recent.popitem(last=False)[0])
+
+    def remove(self, entry_id):
+        signature, _ = self.entries.pop(entry_id)
+        for band, key in enumerate(self.bands(signature)):
+            bucket = self.buckets[band][key]
+            bucket.discard(entry_id)
+            if not bucket:
+                del self.buckets[band][key]
+
+    def match(self, text):
+        '''
+        Finds the cluster for a new channel message, creating a fresh one if nothing similar is indexed,
+        and indexes the text under it. Returns the cluster.
+        '''
+        signature = self.signature(text)
+        cluster = self.query(text, signature)
+        if cluster is None:
+            cluster = Cluster()
+        self.add(text, cluster, signature)
+        return cluster
+
+    def load_csv(self, path, labels=('F',), vocabulary=frozenset()):
+        '''
+        Seeds the index with known claims from a dataset in the en_dup.csv format. Rows whose label is in
+        `labels` become permanent clusters carrying that label's classifier code as their verdict.
+        Returns the number of rows indexed.
+        '''
+        count = 0
+        with open(path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                if row['label'] not in labels or not row['content']:
+                    continue
+                text = normalize_text(row['content'], vocabulary).key
+                signature = self.signature(text)
+                if self.query(text, signature) is not None:
+                    continue # Already covered by an earlier near-identical row
+                self.add(text, Cluster(verdict=LABEL_CODES[row['label']], known=True), signature, pinned=True)
+                count += 1
+        return count
@@ -0,0 +1,87 @@
+# edits.py
+import asyncio
+import logging
+import re
+from collections import OrderedDict
+from normalize import normalize_text
+
+QUIET_SECONDS = 2.0 # How long a message has to stop changing before its final version is evaluated
+MAX_TRACKED = 5000
+
+logger = logging.getLogger('discord')
+
+
+def normalized_content(message):
+    return normalize_text(message.content).key
+
+
+class EditDebouncer:
+    '''
+    Collapses bursts of edits to the same message into one evaluation of its final version, and skips
+    edits whose words didn't change since the version we last looked at. Any changed word counts, however
+    small: 'safe' to 'unsafe' or '5G' to '4G' is exactly the kind of edit worth re-scoring.
+    '''
+
+    def __init__(self, evaluate, normalize=normalized_content, quiet=QUIET_SECONDS, max_tracked=MAX_TRACKED):
+        self.evaluate = evaluate # Coroutine function called with the message once its edits settle
+        self.normalize = normalize # Function from a message to its normalized text
+        self.quiet = quiet
+        self.max_tracked = max_tracked
+        self.baseline = OrderedDict() # Map from message id to the words of the last version we evaluated
+        self.pending = {} # Map from message id to the timer task waiting for edits to settle
+        self.received = 0
+        self.unchanged = 0 # Edits (or settled bursts) with no meaningful change
+        self.superseded = 0 # Edits replaced by a later edit before their quiet window ended
+        self.evaluated = 0
+        self.failed = 0 # Evaluations that raised
+
+    def seen(self, message):
+        '''
+        Records the originally posted version of a message, so the first edit has something to compare against.
+        '''
+        self.remember(message.id, self.words(message))
+
+    def words(self, message):
+        # Only the words matter: case, spacing, punctuation and embeds changing don't warrant a re-score
+        return re.findall(r'\w+', self.normalize(message))
+
+    def remember(self, message_id, message_words):
+        self.baseline[message_id] = message_words
+        self.baseline.move_to_end(message_id)
+        while len(self.baseline) > self.max_tracked:
+            self.baseline.popitem(last=False)
+
+    def submit(self, message):
+        self.received += 1
+        timer = self.pending.get(message.id)
+        if timer is not None:
+            timer.cancel()
+            self.superseded += 1
+        elif self.words(message) == self.baseline.get(message.id):
+            self.unchanged += 1
+            return
+        task = asyncio.get_running_loop().create_task(self.settle(message))
+        task.add_done_callback(self.log_failure)
+        self.pending[message.id] = task
+
+    def log_failure(self, task):
+        # Nobody awaits settle(), so an evaluate() error would otherwise vanish with the task
+        if not task.cancelled() and task.exception() is not None:
+            self.failed += 1
+            logger.error('evaluating an edited message failed', exc_info=task.exception())
+
+    async def settle(self, message):
+        await asyncio.sleep(self.quiet)
+        del self.pending[message.id]
+        # The burst may have ended up back where it started
+        message_words = self.words(message)
+        if message_words == self.baseline.get(message.id):
+            self.unchanged += 1
+            return
+        self.remember(message.id, message_words)
+        self.evaluated += 1
+        await self.evaluate(message)
+
+    def stats(self):
+        return {'received': self.received, 'evaluated': self.evaluated, 'unchanged': self.unchanged, 'superseded': self.superseded,
+                'failed': self.failed}
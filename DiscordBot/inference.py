@@ -0,0 +1,227 @@
+# inference.py
+import asyncio
+import itertools
+import json
+import logging
+import struct
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+MAX_BATCH_SIZE = 8 # Matches eval_batch_size in outputs/model_args.json
+MAX_WAIT_MS = 20
+REQUEST_TIMEOUT = 30 # Seconds to wait for the inference server to answer
+HEADER = struct.Struct('>I') # Frames on the inference server's socket: 4-byte big-endian length, then JSON
+
+logger = logging.getLogger('discord')
+
+PREDICT_SECONDS = metrics.histogram('modbot_predict_seconds', 'Time for one batched model.predict call on the inference thread.')
+BATCH_SIZE = metrics.histogram('modbot_predict_batch_size', 'Texts per model.predict call.', buckets=(1, 2, 4, 8, 16, 32))
+
+
+class InferenceError(Exception):
+    pass
+
+
+async def collect_batch(queue, max_batch_size, max_wait):
+    '''
+    Waits for the first item on the queue, then keeps collecting until the batch is full or the
+    oldest item has waited max_wait seconds.
+    '''
+    loop = asyncio.get_running_loop()
+    batch = [await queue.get()]
+    deadline = loop.time() + max_wait
+    while len(batch) < max_batch_size:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+
+def write_frame(writer, message):
+    data = json.dumps(message).encode('utf-8')
+    writer.write(HEADER.pack(len(data)) + data)
+
+
+async def read_frame(reader):
+    size, = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return json.loads(await reader.readexactly(size))
+
+
+class InferenceScheduler:
+    '''
+    Queues classification requests coming from the event loop and runs them through the model
+    in micro-batches on a worker thread, so a forward pass never blocks the bot.
+    '''
+
+    def __init__(self, model, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS, workers=1):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='inference')
+        self.pending = None # asyncio.Queue of (text, future), created once the event loop is running
+        self.worker = None
+        self.batches = 0
+        self.items = 0
+
+    async def predict(self, text):
+        '''
+        Schedules a single text for classification and waits for its own result.
+        Returns a (prediction, raw_output) pair for that text.
+        '''
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.pending.put((text, future))
+        return await future
+
+    def start(self):
+        # The queue and worker task have to be created from inside the running loop
+        if self.worker is None or self.worker.done():
+            if self.pending is None:
+                self.pending = asyncio.Queue()
+            self.worker = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await collect_batch(self.pending, self.max_batch_size, self.max_wait)
+
+            # Drop requests whose callers have already gone away
+            batch = [(text, future) for text, future in batch if not future.cancelled()]
+            if not batch:
+                continue
+            texts = [text for text, _ in batch]
+            BATCH_SIZE.observe(len(texts))
+            try:
+                with PREDICT_SECONDS.time():
+                    predictions, raw_outputs = await loop.run_in_executor(self.executor, self.model.predict, texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.items += len(batch)
+            for i, (_, future) in enumerate(batch):
+                if not future.done():
+                    future.set_result((predictions[i], raw_outputs[i]))
+
+    async def close(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+        self.executor.shutdown(wait=False)
+
+    def depth(self):
+        return self.pending.qsize() if self.pending is not None else 0
+
+    def stats(self):
+        return {'batches': self.batches, 'items': self.items, 'pending': self.depth()}
+
+
+class InferenceClient:
+    '''
+    Thin async client for inference_server.py with the same predict() as InferenceScheduler. Every
+    caller shares one Unix socket connection; requests are pipelined and matched to their responses by
+    id, and the server does the batching. When the server is saturated it stops reading, so sends here
+    wait in drain() rather than piling up more work.
+    '''
+
+    def __init__(self, path, timeout=REQUEST_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.connecting = None # asyncio.Lock, created once the event loop is running
+        self.receiver = None # Task reading responses off the current connection
+        self.waiting = {} # Map from request id to the future waiting for its response
+        self.ids = itertools.count()
+        self.items = 0
+
+    async def connect(self):
+        if self.connecting is None:
+            self.connecting = asyncio.Lock()
+        async with self.connecting:
+            if self.writer is None or self.writer.is_closing():
+                self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+                self.receiver = asyncio.get_running_loop().create_task(self.receive(self.reader, self.writer))
+
+    async def receive(self, reader, writer):
+        reason = 'lost the connection to the inference server'
+        future = None # The one being answered, already out of self.waiting
+        try:
+            while True:
+                future = None
+                response = await read_frame(reader)
+                future = self.waiting.pop(response['id'], None)
+                if future is None or future.done():
+                    continue
+                if 'error' in response:
+                    future.set_exception(InferenceError(response['error']))
+                elif 'version' in response:
+                    future.set_result(response['version'])
+                else:
+                    future.set_result((response['prediction'], response['raw_output']))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            # A frame we can't make sense of leaves the stream out of step, so drop the connection too
+            logger.exception('bad response from the inference server, reconnecting')
+            reason = f'bad response from the inference server: {e!r}'
+        finally:
+            # Fail everyone still waiting on this connection; the next predict reconnects
+            writer.close()
+            if self.writer is writer:
+                self.writer = None
+            for future in [future] + list(self.waiting.values()):
+                if future is not None and not future.done():
+                    future.set_exception(InferenceError(reason))
+            self.waiting.clear()
+
+    async def request(self, message):
+        await self.connect()
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[request_id] = future
+        try:
+            write_frame(self.writer, {'id': request_id, **message})
+            await self.writer.drain()
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            self.waiting.pop(request_id, None)
+
+    async def predict(self, text):
+        '''
+        Sends a single text to the inference server and waits for its (prediction, raw_output) pair.
+        '''
+        result = await self.request({'text': text})
+        self.items += 1
+        return result
+
+    async def version(self):
+        '''
+        Asks the server which model and backend it is serving, as 'model/backend'.
+        '''
+        return await self.request({'version': True})
+
+    def depth(self):
+        return len(self.waiting)
+
+    def stats(self):
+        return {'items': self.items, 'pending': self.depth()}
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.receiver is not None:
+            self.receiver.cancel()
+            self.receiver = None
@@ -0,0 +1,202 @@
+# inference_server.py
+'''
+Standalone classifier service shared by several bot processes on the same machine. The model is
+loaded once in this process and then a pool of worker processes is forked. The workers share the
+weights copy-on-write instead of each holding its own copy. Requests from every connected bot are
+micro-batched together and spread over the workers. Once max-pending texts are waiting, the server
+stops reading from its clients until some are answered, so a burst pushes back on the bots instead of
+queueing without bound.
+
+    python inference_server.py --socket /tmp/modbot-inference.sock --workers 4 --backend quantized
+
+Then set INFERENCE_SOCKET in bot.py to the same path. Only the PyTorch backends are served: ONNX
+Runtime sessions aren't fork-safe, and simpletransformers starts its own process pool when predicting.
+'''
+import argparse
+import asyncio
+import gc
+import itertools
+import multiprocessing
+import os
+import signal
+import time
+import numpy as np
+from backends import load_backend
+from inference import collect_batch, read_frame, write_frame, MAX_BATCH_SIZE, MAX_WAIT_MS
+
+SOCKET_PATH = '/tmp/modbot-inference.sock'
+SERVED_BACKENDS = ['torch', 'quantized']
+STATS_INTERVAL = 10
+BATCH_TIMEOUT = 60 # Seconds before a batch is given up on, e.g. because its worker died
+
+# Loaded in the parent before the pool is forked, so every worker inherits the same pages
+model = None
+
+
+def init_worker(threads):
+    # Ctrl-C is for the server, which shuts the pool down itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Each worker gets its own slice of the cores rather than all of them contending for every core
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    model.predict(['Warming up the classifier.'])
+
+
+def predict_batch(texts):
+    predictions, raw_outputs = model.predict(texts)
+    return [int(p) for p in predictions], np.asarray(raw_outputs, dtype=np.float64).tolist()
+
+
+class InferenceServer:
+    def __init__(self, pool, workers, version, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS, max_pending=256,
+                 batch_timeout=BATCH_TIMEOUT):
+        self.pool = pool
+        self.workers = workers
+        self.version = version # 'model/backend', which clients key their verdict caches on
+        self.batch_timeout = batch_timeout
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_pending = max_pending
+        # Created once the event loop is running
+        self.pending = None # asyncio.Queue of (text, future) waiting to be batched
+        self.slots = None # Semaphore with one slot per worker, so a batch only forms once a worker is free
+        self.capacity = None # Semaphore bounding the texts accepted but not yet answered
+        self.running = {} # Map from batch number to (batch, timeout handle) for batches out on a worker
+        self.timeouts = 0
+        self.connections = 0
+        self.batches = 0
+        self.items = 0
+
+    async def serve(self, path):
+        self.pending = asyncio.Queue()
+        self.slots = asyncio.Semaphore(self.workers)
+        self.capacity = asyncio.Semaphore(self.max_pending)
+        if os.path.exists(path):
+            os.unlink(path)
+        server = await asyncio.start_unix_server(self.handle, path)
+        os.chmod(path, 0o660)
+        loop = asyncio.get_running_loop()
+        loop.create_task(self.batcher())
+        loop.create_task(self.report())
+        print(f'serving {self.workers} workers on {path}')
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                request = await read_frame(reader)
+                if request.get('version'):
+                    write_frame(writer, {'id': request['id'], 'version': self.version})
+                    continue
+                # Backpressure: while we're full, we don't read the next request
+                await self.capacity.acquire()
+                future = loop.create_future()
+                future.add_done_callback(lambda f, request_id=request['id']: self.respond(writer, request_id, f))
+                self.pending.put_nowait((request['text'], future))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    def respond(self, writer, request_id, future):
+        self.capacity.release()
+        if writer.is_closing():
+            return
+        if future.exception() is not None:
+            write_frame(writer, {'id': request_id, 'error': repr(future.exception())})
+        else:
+            prediction, raw_output = future.result()
+            write_frame(writer, {'id': request_id, 'prediction': prediction, 'raw_output': raw_output})
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        for number in itertools.count():
+            # Wait for a free worker before forming the batch, so texts arriving meanwhile make it bigger
+            await self.slots.acquire()
+            batch = await collect_batch(self.pending, self.max_batch_size, self.max_wait)
+            texts = [text for text, _ in batch]
+
+            # The pool calls back on its result thread, so hand the outcome back to the loop
+            def done(result, number=number):
+                loop.call_soon_threadsafe(self.finish, number, result, None)
+
+            def failed(error, number=number):
+                loop.call_soon_threadsafe(self.finish, number, None, error)
+            # If the worker dies mid-batch the pool never calls back at all, so the timeout frees the
+            # slot and the batch's capacity instead
+            timeout = loop.call_later(self.batch_timeout, self.expire, number)
+            self.running[number] = (batch, timeout)
+            self.pool.apply_async(predict_batch, (texts,), callback=done, error_callback=failed)
+
+    def expire(self, number):
+        self.timeouts += 1
+        print(f'{time.strftime("%H:%M:%S")} batch {number} took over {self.batch_timeout}s, giving up on it')
+        self.finish(number, None, TimeoutError(f'no result from the worker after {self.batch_timeout}s'))
+
+    def finish(self, number, result, error):
+        if number not in self.running:
+            return # Already timed out
+        batch, timeout = self.running.pop(number)
+        timeout.cancel()
+        self.slots.release()
+        self.batches += 1
+        self.items += len(batch)
+        for i, (_, future) in enumerate(batch):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result((result[0][i], result[1][i]))
+
+    async def report(self):
+        items = 0
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            rate = (self.items - items) / STATS_INTERVAL
+            items = self.items
+            print(f'{time.strftime("%H:%M:%S")} {self.connections} clients, {rate:.1f} texts/s, '
+                  f'{self.items / max(self.batches, 1):.1f} texts/batch, {self.pending.qsize()} queued, {self.timeouts} timed out')
+
+
+def main():
+    global model
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--socket', default=SOCKET_PATH)
+    parser.add_argument('--model', default='checkpoint-3750-epoch-10')
+    parser.add_argument('--backend', default='quantized', choices=SERVED_BACKENDS)
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument('--threads', type=int, default=1, help='torch threads per worker')
+    parser.add_argument('--max-batch-size', type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument('--max-wait-ms', type=float, default=MAX_WAIT_MS)
+    parser.add_argument('--max-pending', type=int, default=256, help='texts accepted but not yet answered before clients are held off')
+    parser.add_argument('--batch-timeout', type=float, default=BATCH_TIMEOUT, help='seconds before a batch whose worker never answers is failed')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    model = load_backend(args.backend, args.model)
+    print(f'loaded {args.model} ({args.backend}) in {time.perf_counter() - start:.1f}s')
+    # Move everything allocated so far out of the collector's reach, so collections in the workers
+    # don't write to (and un-share) the pages holding the model
+    gc.freeze()
+    # Fork before starting the event loop, so the workers don't inherit a running loop
+    pool = multiprocessing.get_context('fork').Pool(args.workers, initializer=init_worker, initargs=(args.threads,))
+    server = InferenceServer(pool, args.workers, args.model + '/' + args.backend, args.max_batch_size, args.max_wait_ms,
+                             args.max_pending, args.batch_timeout)
+    try:
+        asyncio.run(server.serve(args.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.terminate()
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# logs.py
+import logging
+import logging.handlers
+import queue
+import metrics
+
+LOG_FORMAT = '%(asctime)s:%(levelname)s:%(name)s: %(message)s'
+# discord.py logs a DEBUG line for every gateway event and every dispatch; keep one in this many
+DEBUG_SAMPLE_RATE = 100
+NOISY_LOGGERS = ('discord.gateway', 'discord.client', 'discord.state', 'discord.http')
+
+DROPPED = metrics.counter('modbot_log_records_sampled_out_total', 'DEBUG records from the discord gateway dropped by sampling.')
+
+
+class DebugSampler(logging.Filter):
+    '''
+    Lets through every record at INFO and above, but only one in `rate` DEBUG records from the
+    noisy discord.py loggers, counted per logger so a quiet logger isn't starved by a busy one.
+    '''
+
+    def __init__(self, rate=DEBUG_SAMPLE_RATE, noisy=NOISY_LOGGERS):
+        super().__init__()
+        self.rate = rate
+        self.noisy = noisy
+        self.seen = {} # Map from logger name to the number of DEBUG records it has sent
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or not record.name.startswith(self.noisy):
+            return True
+        count = self.seen.get(record.name, 0)
+        self.seen[record.name] = count + 1
+        if count % self.rate == 0:
+            return True
+        DROPPED.inc()
+        return False
+
+
+def setup_logging(path='discord.log', level=logging.DEBUG, console_level=logging.INFO, sample_rate=DEBUG_SAMPLE_RATE):
+    '''
+    Sends the discord logger's records through a queue to a listener thread that does the formatting and
+    file/console I/O, so logging never blocks the event loop on disk. Returns the listener; stop() it on exit
+    to flush what's still queued.
+    '''
+    records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    # Sample before the record is queued, so dropped records cost next to nothing
+    handler.addFilter(DebugSampler(sample_rate))
+
+    file_handler = logging.FileHandler(filename=path, encoding='utf-8', mode='w')
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(console_level)
+    console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(records, file_handler, console_handler, respect_handler_level=True)
+
+    logger = logging.getLogger('discord')
+    logger.setLevel(level)
+    logger.addHandler(handler)
+    listener.start()
+    return listener
@@ -0,0 +1,65 @@
+# messagecache.py
+import time
+from collections import OrderedDict
+import metrics
+
+MAX_MESSAGES = 5000
+
+FETCH_SECONDS = metrics.histogram('modbot_fetch_message_seconds', 'Time for fetch_message calls made on cache misses.')
+
+
+class RecentMessages:
+    '''
+    Bounded, ID-indexed cache of the channel messages the bot has recently seen (latest edit wins), so
+    report intake can usually find a reported message without a fetch_message round trip.
+    '''
+
+    def __init__(self, max_messages=MAX_MESSAGES):
+        self.max_messages = max_messages
+        self.messages = OrderedDict() # Map from message id to the message, oldest first
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+        self.fetch_seconds = 0.0 # Total time spent in fetch_message on misses
+
+    def put(self, message):
+        self.messages[message.id] = message
+        self.messages.move_to_end(message.id)
+        while len(self.messages) > self.max_messages:
+            self.messages.popitem(last=False)
+
+    def discard(self, message_id):
+        self.messages.pop(message_id, None)
+
+    async def get(self, channel, message_id):
+        '''
+        Returns the message from the cache if we've seen it in this channel, otherwise fetches it from Discord
+        (raising discord.errors.NotFound like fetch_message does) and caches the result.
+        '''
+        message = self.messages.get(message_id)
+        if message is not None and message.channel.id == channel.id:
+            self.hits += 1
+            return message
+
+        self.misses += 1
+        start = time.perf_counter()
+        try:
+            message = await channel.fetch_message(message_id)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.fetches += 1
+            self.fetch_seconds += elapsed
+            FETCH_SECONDS.observe(elapsed)
+        self.put(message)
+        return message
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        mean_fetch = self.fetch_seconds / self.fetches if self.fetches else 0.0
+        return {
+            'messages': len(self.messages),
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'mean_fetch_seconds': mean_fetch,
+            # Every hit is a fetch we didn't have to make
+            'fetch_seconds_saved': self.hits * mean_fetch,
+        }
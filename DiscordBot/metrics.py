@@ -0,0 +1,137 @@
+# metrics.py
+import bisect
+import time
+from contextlib import contextmanager
+from aiohttp import web
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Seconds, from a cache lookup up to a slow forward pass or a rate-limited send
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Metric:
+    def __init__(self, kind, name, documentation):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Counter(Metric):
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__('counter', name, documentation)
+        # Map from sorted (label, value) pairs to the count; a counter without labels starts at zero
+        self.values = {} if labelnames else {(): 0}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        return self.header() + [f'{self.name}{format_labels(key)} {value}' for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    '''
+    A value read from the bot's state when the metrics are scraped, so nothing has to keep it up to date.
+    '''
+
+    def __init__(self, name, documentation, read):
+        super().__init__('gauge', name, documentation)
+        self.read = read
+
+    def render(self):
+        return self.header() + [f'{self.name} {self.read()}']
+
+
+class Histogram(Metric):
+    def __init__(self, name, documentation, buckets=BUCKETS):
+        super().__init__('histogram', name, documentation)
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # The last one counts observations above every bucket
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        # Works around awaits too, the time spent suspended is part of what callers wait for
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def render(self):
+        lines = self.header()
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{self.name}_sum {self.sum}')
+        lines.append(f'{self.name}_count {self.count}')
+        return lines
+
+
+class Registry:
+    '''
+    The bot's metrics, rendered in the Prometheus text exposition format. Metrics are only updated
+    from the event loop, so they don't need locks.
+    '''
+
+    def __init__(self):
+        self.metrics = {} # Map from name to metric, in registration order
+
+    def register(self, metric):
+        # Registering a name again replaces the old metric (e.g. a gauge reading a new client)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, read):
+    return REGISTRY.register(Gauge(name, documentation, read))
+
+
+def histogram(name, documentation, buckets=BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, buckets))
+
+
+async def serve(host='127.0.0.1', port=9152, registry=REGISTRY):
+    '''
+    Serves the registry at http://host:port/metrics for Prometheus to scrape. Returns the runner to clean up.
+    '''
+    async def handle(request):
+        return web.Response(body=registry.render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
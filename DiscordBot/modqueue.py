@@ -0,0 +1,128 @@
+# modqueue.py
+import heapq
+import itertools
+import math
+import time
+
+MAX_IN_REVIEW = 3 # Reports shown to a guild's moderators at the same time
+AGING_SECONDS = 600 # Waiting this long is worth one point of priority
+KARMA_WEIGHT = 0.5
+KARMA_CAP = 6
+AUTO_RISK = 3 # Automatic reports are COVID-19 misinformation, scaled by classifier confidence
+
+# How urgent each specific category is; anything not listed counts as 1
+CATEGORY_RISK = {
+    'Expresses intentions of self-harm or suicide': 5,
+    'Child Sexual Abuse Materials': 5,
+    'Human Trafficking': 5,
+    'Expresses intentions for harming others': 4,
+    'Dangerous or Violent Organizations': 4,
+    'Elections': 3,
+    'Covid-19': 3,
+    'Other Health or Medical': 2,
+}
+
+
+def confidence(raw_output, flagged=(0, 2)):
+    '''
+    Turns the classifier's raw output (logits) into the probability that the message should be flagged.
+    '''
+    top = max(raw_output)
+    exps = [math.exp(x - top) for x in raw_output]
+    return sum(exps[i] for i in flagged) / sum(exps)
+
+
+def priority(report, karma):
+    '''
+    Higher is more urgent: category risk (or classifier confidence for automatic reports) plus
+    how often the reported user has been reported before.
+    '''
+    if report.reporter == 'auto':
+        score = AUTO_RISK * report.confidence
+    else:
+        score = CATEGORY_RISK.get(report.specificCategory, 1)
+    return score + KARMA_WEIGHT * min(karma, KARMA_CAP)
+
+
+class ModerationQueue:
+    '''
+    Pending reports for every guild, each guild ordered by priority in its own heap. Up to
+    MAX_IN_REVIEW reports per guild are out for review at once, and moderator replies are
+    routed back to the report they answer by the id of the prompt the bot posted for it.
+    '''
+
+    def __init__(self, max_in_review=MAX_IN_REVIEW, last_id=0):
+        self.max_in_review = max_in_review
+        self.ids = itertools.count(last_id + 1)
+        self.heaps = {} # Map from guild id to a heap of (sort key, report id)
+        self.pending = {} # Map from report id to the report, for reports waiting in a heap
+        self.in_review = {} # Map from guild id to {report id: report} currently shown to moderators
+        self.prompts = {} # Map from the id of the bot's prompt message to the report id it shows
+
+    def push(self, guild_id, report, score):
+        '''
+        Adds a report to its guild's queue and returns its unique id. Reports restored from storage
+        keep the id and creation time they already have.
+        '''
+        if report.id is None:
+            report.id = next(self.ids)
+        if report.created is None:
+            report.created = time.time()
+        report.guild_id = guild_id
+        # Ageing is linear for every report, so ordering by (creation time - score) once at push time
+        # gives the same order as re-scoring everything with its current age
+        key = report.created / AGING_SECONDS - score
+        heapq.heappush(self.heaps.setdefault(guild_id, []), (key, report.id))
+        self.pending[report.id] = report
+        return report.id
+
+    def next_for_review(self, guild_id):
+        '''
+        Pops the most urgent pending report if the guild has a free review slot, otherwise returns None.
+        '''
+        reviewing = self.in_review.setdefault(guild_id, {})
+        heap = self.heaps.get(guild_id)
+        if len(reviewing) >= self.max_in_review or not heap:
+            return None
+        _, report_id = heapq.heappop(heap)
+        report = self.pending.pop(report_id)
+        reviewing[report_id] = report
+        return report
+
+    def track_prompt(self, prompt_id, report):
+        self.prompts[prompt_id] = report.id
+        report.prompt_id = prompt_id
+
+    def route(self, guild_id, message):
+        '''
+        Finds the report a moderator's message answers: a Discord reply to the report's prompt, a message
+        starting with `#<report id>`, or the only report in review for the guild. Returns (report, answer).
+        '''
+        reviewing = self.in_review.get(guild_id, {})
+        content = message.content.strip()
+
+        reference = getattr(message, 'reference', None)
+        if reference is not None and self.prompts.get(reference.message_id) in reviewing:
+            return reviewing[self.prompts[reference.message_id]], content
+
+        if content.startswith('#'):
+            number, _, answer = content[1:].partition(' ')
+            if number.isdigit() and int(number) in reviewing:
+                return reviewing[int(number)], answer.strip()
+
+        if len(reviewing) == 1:
+            return next(iter(reviewing.values())), content
+        return None, content
+
+    def reviewing(self, guild_id):
+        '''
+        Ids of the guild's reports currently out for review, oldest first.
+        '''
+        return sorted(self.in_review.get(guild_id, {}))
+
+    def finish(self, report):
+        self.in_review.get(report.guild_id, {}).pop(report.id, None)
+        self.prompts.pop(report.prompt_id, None)
+
+    def __len__(self):
+        return len(self.pending) + sum(len(reviewing) for reviewing in self.in_review.values())
@@ -0,0 +1,83 @@
+# normalize.py
+import csv
+import re
+from collections import OrderedDict, namedtuple
+from unidecode import unidecode # for disguised unicode characters
+
+MAX_ENTRIES = 10000
+
+# Zero-width and other invisible characters used to split words so filters don't match them
+INVISIBLE = re.compile('[\u00ad\u034f\u061c\u115f\u1160\u17b4\u17b5\u180b-\u180e\u200b-\u200f\u202a-\u202e'
+                       '\u2060-\u206f\u3164\ufe00-\ufe0f\ufeff\uffa0]')
+# Symbols that stand in for letters, which unidecode would otherwise spell out (e.g. € -> EUR)
+HOMOGLYPHS = str.maketrans({'€': 'e', '£': 'l', '¢': 'c', '¥': 'y', '©': 'c', '®': 'r', '¡': 'i', '§': 's', '∂': 'd', 'Ø': 'O', 'ø': 'o'})
+LEET = str.maketrans({'0': 'o', '1': 'i', '3': 'e', '4': 'a', '5': 's', '7': 't', '@': 'a', '$': 's'})
+LEET_TOKEN = re.compile(r'[A-Za-z0-9@$]*[A-Za-z][A-Za-z0-9@$]*')
+WHITESPACE = re.compile(r'\s+')
+
+# ascii: transliterated, invisible characters removed and whitespace collapsed (what we show people)
+# text: ascii with look-alike symbols and leetspeak folded back into letters (what the models see)
+# key: text case-folded (what caches and duplicate detection compare)
+Normalized = namedtuple('Normalized', ['ascii', 'text', 'key'])
+
+
+def load_vocabulary(path):
+    '''
+    Lower-cased words of three or more letters from a dataset in the en_dup.csv format. Leetspeak is
+    only folded when that turns a token into one of these words, so things like H1N1 or N95 survive.
+    '''
+    vocabulary = set()
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            vocabulary.update(word.lower() for word in re.findall(r'[A-Za-z]{3,}', row['content']))
+    return vocabulary
+
+
+def normalize_text(text, vocabulary=frozenset()):
+    ascii_text = WHITESPACE.sub(' ', unidecode(INVISIBLE.sub('', text).translate(HOMOGLYPHS))).strip()
+    folded = ascii_text
+    if vocabulary:
+        def fold(match):
+            token = match.group(0)
+            candidate = token.translate(LEET)
+            if candidate != token and candidate.lower() in vocabulary and token.lower() not in vocabulary:
+                return candidate
+            return token
+        folded = LEET_TOKEN.sub(fold, ascii_text)
+    return Normalized(ascii_text, folded, folded.casefold())
+
+
+class Normalizer:
+    '''
+    Normalizes each message once and memoizes the result by message id and content hash, so the
+    classifier, Perspective, the caches, duplicate detection and report intake share one pass and
+    the discord.Message itself is never modified. Edits change the content hash and are redone, and
+    setting a new vocabulary (once the dataset has loaded) starts the memo afresh.
+    '''
+
+    def __init__(self, max_entries=MAX_ENTRIES, vocabulary=frozenset()):
+        self.max_entries = max_entries
+        self.vocabulary = vocabulary
+        self.memo = OrderedDict() # Map from (message id, content hash) to its Normalized text
+        self.hits = 0
+        self.misses = 0
+
+    def set_vocabulary(self, vocabulary):
+        # Results folded without it (posts seen during startup) would miss the known-claims index and
+        # get different verdict-cache keys, so nothing memoized before is kept
+        self.vocabulary = vocabulary
+        self.memo.clear()
+
+    def normalize(self, message):
+        key = (message.id, hash(message.content))
+        result = self.memo.get(key)
+        if result is not None:
+            self.hits += 1
+            self.memo.move_to_end(key)
+            return result
+        self.misses += 1
+        result = normalize_text(message.content, self.vocabulary)
+        self.memo[key] = result
+        while len(self.memo) > self.max_entries:
+            self.memo.popitem(last=False)
+        return result
@@ -0,0 +1,107 @@
+# perspective.py
+import asyncio
+import json
+import random
+import aiohttp
+
+PERSPECTIVE_URL = 'https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze'
+ATTRIBUTES = ['SEVERE_TOXICITY', 'PROFANITY', 'IDENTITY_ATTACK', 'THREAT', 'TOXICITY', 'FLIRTATION']
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRY_AFTER = 10.0 # Longest we honour a server's Retry-After, in seconds
+
+
+class PerspectiveError(Exception):
+    pass
+
+
+class PerspectiveClient:
+    '''
+    Async client for the Perspective API. Keeps one pooled keep-alive session, caps the number of
+    requests in flight, retries throttled or failed calls with backoff, and shares a single request
+    between callers asking about the same text at the same time.
+    '''
+
+    def __init__(self, key, url=PERSPECTIVE_URL, max_concurrency=4, timeout=5.0, retries=3, backoff=0.5):
+        self.key = key
+        self.url = url
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = None
+        self.semaphore = None
+        self.inflight = {} # Map from text to the task already scoring it
+
+    async def get_session(self):
+        # The session has to be created from inside the running loop
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self.session
+
+    async def score(self, text):
+        '''
+        Returns a dictionary mapping each requested attribute to its summary score for the given text.
+        '''
+        task = self.inflight.get(text)
+        if task is None:
+            # The request runs in its own task, so one caller being cancelled doesn't cancel it for the rest
+            task = asyncio.get_running_loop().create_task(self.request(text))
+            self.inflight[text] = task
+            task.add_done_callback(lambda task: self.finished(text, task))
+        return await asyncio.shield(task)
+
+    def finished(self, text, task):
+        if self.inflight.get(text) is task:
+            del self.inflight[text]
+        # Mark the exception as retrieved in case every caller was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    async def request(self, text):
+        session = await self.get_session()
+        data_dict = {
+            'comment': {'text': text},
+            'languages': ['en'],
+            'requestedAttributes': {attr: {} for attr in ATTRIBUTES},
+            'doNotStore': True
+        }
+
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            retry, retry_after = False, None
+            try:
+                async with self.semaphore:
+                    async with session.post(self.url, params={'key': self.key}, data=json.dumps(data_dict)) as response:
+                        if response.status in RETRY_STATUSES and not last_attempt:
+                            retry, retry_after = True, response.headers.get('Retry-After')
+                        elif response.status != 200:
+                            raise PerspectiveError(f'Perspective returned HTTP {response.status}')
+                        else:
+                            response_dict = await response.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if last_attempt:
+                    raise PerspectiveError(f'Perspective request failed: {e!r}') from e
+                retry = True
+            if retry:
+                # Back off only once the slot and the connection are released, so other texts can use them
+                await self.sleep(attempt, retry_after)
+                continue
+
+            scores = {}
+            for attr in response_dict["attributeScores"]:
+                scores[attr] = response_dict["attributeScores"][attr]["summaryScore"]["value"]
+            return scores
+
+    async def sleep(self, attempt, retry_after=None):
+        # Exponential backoff with jitter, unless the server told us how long to wait
+        try:
+            delay = min(max(float(retry_after), 0.0), MAX_RETRY_AFTER)
+        except (TypeError, ValueError):
+            delay = self.backoff * (2 ** attempt) * (0.5 + random.random())
+        await asyncio.sleep(delay)
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
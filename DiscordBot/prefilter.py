@@ -0,0 +1,182 @@
+# prefilter.py
+'''
+Cheap first stage of the classification cascade: a hashed n-gram TF-IDF logistic regression trained
+on en_dup.csv. Confident messages are decided here in microseconds; only the uncertain band goes on
+to the RoBERTa model.
+
+    python prefilter.py --data ../en_dup.csv --out prefilter.pkl
+'''
+import argparse
+import asyncio
+import csv
+import logging
+import pickle
+import random
+import numpy as np
+import metrics
+from duplicates import LABEL_CODES
+
+FLAGGED = [0, 2] # Codes the bot auto-reports
+LOW = 0.1 # At or below this flag probability the prefilter calls the message benign
+HIGH = 0.9 # At or above this flag probability the prefilter flags the message itself
+AUDIT_RATE = 0.02 # Fraction of prefilter decisions double-checked by the full model
+
+logger = logging.getLogger('discord')
+
+CASCADE_TEXTS = metrics.counter('modbot_cascade_texts_total', 'Texts classified through the cascade, by the stage that decided them.', labelnames=('stage',))
+AUDITED_FLAGS = metrics.counter('modbot_prefilter_audited_flags_total', 'Audited prefilter decisions the full model flagged.')
+AUDITED_CAUGHT = metrics.counter('modbot_prefilter_audited_caught_total', 'Audited prefilter decisions flagged by both the full model and the prefilter.')
+
+
+def build_pipeline():
+    from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+    return make_pipeline(
+        HashingVectorizer(n_features=2 ** 18, ngram_range=(1, 2), alternate_sign=False, norm=None),
+        TfidfTransformer(sublinear_tf=True),
+        LogisticRegression(max_iter=1000, class_weight='balanced'),
+    )
+
+
+def load_rows(path):
+    texts, labels = [], []
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            if row['label'] in LABEL_CODES and row['content']:
+                texts.append(row['content'])
+                labels.append(LABEL_CODES[row['label']])
+    return texts, labels
+
+
+class Prefilter:
+    '''
+    Wraps the trained pipeline and turns its probabilities into a decision, or None when unsure.
+    '''
+
+    def __init__(self, pipeline, low=LOW, high=HIGH):
+        self.pipeline = pipeline
+        self.low = low
+        self.high = high
+        self.columns = [list(pipeline.classes_).index(code) for code in FLAGGED]
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        with open(path, 'rb') as f:
+            return cls(pickle.load(f), **kwargs)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self.pipeline, f)
+
+    def decide(self, text):
+        '''
+        Returns (prediction, probabilities) if the message is confidently benign or flagged, else (None, probabilities).
+        '''
+        probabilities = self.pipeline.predict_proba([text])[0]
+        flag_probability = probabilities[self.columns].sum()
+        if flag_probability <= self.low:
+            return 1, probabilities
+        if flag_probability >= self.high:
+            return FLAGGED[int(np.argmax(probabilities[self.columns]))], probabilities
+        return None, probabilities
+
+
+class Cascade:
+    '''
+    Runs the prefilter first and escalates to the transformer scheduler only for uncertain messages.
+    A small random sample of prefilter decisions is also sent to the transformer so we can track how
+    much of the full model's recall the cascade keeps. Audits run in the background, so the sampled
+    message gets the prefilter's answer as quickly as any other.
+    '''
+
+    def __init__(self, prefilter, scheduler, audit_rate=AUDIT_RATE):
+        self.prefilter = prefilter
+        self.scheduler = scheduler
+        self.audit_rate = audit_rate
+        self.decided = 0
+        self.escalated = 0
+        self.audited_flags = 0 # Audited messages the full model flagged
+        self.audited_caught = 0 # ...of which the prefilter flagged too
+        self.audits = set() # Audit tasks still running, referenced so they aren't garbage-collected
+
+    async def predict(self, text):
+        prediction, probabilities = self.prefilter.decide(text)
+        if prediction is None:
+            self.escalated += 1
+            CASCADE_TEXTS.inc(stage='model')
+            return await self.scheduler.predict(text)
+
+        self.decided += 1
+        CASCADE_TEXTS.inc(stage='prefilter')
+        if random.random() < self.audit_rate:
+            task = asyncio.get_running_loop().create_task(self.audit(text, prediction))
+            self.audits.add(task)
+            task.add_done_callback(self.audits.discard)
+        # Log-probabilities, so callers can treat them like the transformer's logits
+        return prediction, np.log(np.maximum(probabilities, 1e-12))
+
+    async def audit(self, text, prediction):
+        try:
+            full_prediction, _ = await self.scheduler.predict(text)
+        except Exception:
+            logger.warning('prefilter audit failed', exc_info=True)
+            return
+        if full_prediction in FLAGGED:
+            self.audited_flags += 1
+            AUDITED_FLAGS.inc()
+            if prediction in FLAGGED:
+                self.audited_caught += 1
+                AUDITED_CAUGHT.inc()
+
+    def stats(self):
+        total = self.decided + self.escalated
+        return {
+            'messages': total,
+            'offloaded': self.decided / total if total else 0.0,
+            'audited_recall': self.audited_caught / self.audited_flags if self.audited_flags else None,
+        }
+
+
+def main():
+    from sklearn.metrics import classification_report
+    from sklearn.model_selection import train_test_split
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data', default='../en_dup.csv')
+    parser.add_argument('--out', default='prefilter.pkl')
+    parser.add_argument('--low', type=float, default=LOW)
+    parser.add_argument('--high', type=float, default=HIGH)
+    parser.add_argument('--teacher', default=None, help='checkpoint folder; if given, recall is measured against its predictions instead of the labels')
+    args = parser.parse_args()
+
+    texts, labels = load_rows(args.data)
+    train_x, test_x, train_y, test_y = train_test_split(texts, labels, test_size=0.2, stratify=labels, random_state=152)
+    pipeline = build_pipeline().fit(train_x, train_y)
+    print(classification_report(test_y, pipeline.predict(test_x), target_names=list(LABEL_CODES)))
+
+    reference = test_y
+    if args.teacher:
+        from backends import load_backend
+        reference = list(load_backend('simpletransformers', args.teacher).predict(test_x)[0])
+
+    prefilter = Prefilter(pipeline, low=args.low, high=args.high)
+    decided = flagged = caught = 0
+    for text, ref in zip(test_x, reference):
+        prediction, _ = prefilter.decide(text)
+        if prediction is not None:
+            decided += 1
+        if ref in FLAGGED:
+            flagged += 1
+            # Escalated messages get the full model's answer, so only confident misses lose recall
+            if prediction is None or prediction in FLAGGED:
+                caught += 1
+    print(f'offloaded {decided / len(test_x):.1%} of held-out messages to the prefilter')
+    print(f'cascade recall on flagged messages: {caught / max(flagged, 1):.1%}')
+
+    # Retrain on everything for the shipped model
+    Prefilter(build_pipeline().fit(texts, labels), low=args.low, high=args.high).save(args.out)
+    print(f'saved {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+# store.py
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import closing
+import metrics
+
+BATCH_SIZE = 256 # Writes grouped into a single transaction
+FLUSH_INTERVAL = 0.05 # Longest a write waits for others to join its transaction, in seconds
+WRITE_ATTEMPTS = 3 # Tries for a single write that keeps failing with a transient error (locked, busy, I/O)
+
+logger = logging.getLogger('discord')
+
+DROPPED_WRITES = metrics.counter('modbot_store_dropped_writes_total', 'Report store writes given up on after failing.')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS reports (
+    id INTEGER PRIMARY KEY,
+    guild_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    reported_user_id INTEGER NOT NULL,
+    reported_user_name TEXT,
+    content TEXT,
+    reporter TEXT,
+    broad_category TEXT,
+    specific_category TEXT,
+    optional_message TEXT,
+    post_visibility TEXT,
+    user_visibility TEXT,
+    confidence REAL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    decision TEXT,
+    created REAL NOT NULL,
+    closed REAL
+);
+CREATE INDEX IF NOT EXISTS reports_by_user ON reports (reported_user_id);
+CREATE INDEX IF NOT EXISTS reports_by_guild ON reports (guild_id, status);
+CREATE INDEX IF NOT EXISTS pending_reports ON reports (status) WHERE status = 'pending';
+CREATE TABLE IF NOT EXISTS karma (
+    user_id INTEGER PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+'''
+
+
+class ReportStore:
+    '''
+    SQLite (WAL mode) persistence for reports and karma. Writes are queued and committed in groups by a
+    background thread so the event loop never waits on disk; reads only happen at startup.
+    '''
+
+    def __init__(self, path, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        with closing(self.connect()) as conn:
+            conn.executescript(SCHEMA)
+        self.writes = queue.Queue()
+        self.writer = threading.Thread(target=self.run, name='report-store', daemon=True)
+        self.writer.start()
+
+    def connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL') # Safe with WAL; only the last transactions can be lost on power failure
+        return conn
+
+    def run(self):
+        conn = self.connect()
+        stopping = False
+        while not stopping:
+            batch = [self.writes.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.writes.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [item for item in batch if item is not None]
+            if batch:
+                self.commit(conn, batch)
+        conn.close()
+
+    def commit(self, conn, batch):
+        '''
+        Commits the batch in one transaction. If that fails the writes are retried one at a time, so a
+        single bad statement only loses itself, and the writer thread carries on either way.
+        '''
+        try:
+            with conn:
+                for sql, params in batch:
+                    conn.execute(sql, params)
+            return
+        except sqlite3.Error:
+            logger.exception('report store: batch of %d writes failed, retrying them one by one', len(batch))
+        for sql, params in batch:
+            for attempt in range(WRITE_ATTEMPTS):
+                try:
+                    with conn:
+                        conn.execute(sql, params)
+                    break
+                except sqlite3.OperationalError:
+                    # Locked, busy or a disk hiccup: worth another try after a moment
+                    if attempt == WRITE_ATTEMPTS - 1:
+                        logger.exception('report store: giving up on %r %r', sql.split()[0], params)
+                        DROPPED_WRITES.inc()
+                    else:
+                        time.sleep(0.1 * (attempt + 1))
+                except sqlite3.Error:
+                    logger.exception('report store: skipping %r %r', sql.split()[0], params)
+                    DROPPED_WRITES.inc()
+                    break
+
+    def add_report(self, report):
+        m = report.reportedMessage
+        self.writes.put(('''INSERT OR REPLACE INTO reports
+            (id, guild_id, channel_id, message_id, reported_user_id, reported_user_name, content, reporter,
+             broad_category, specific_category, optional_message, post_visibility, user_visibility, confidence, created)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            (report.id, m.guild_id, m.channel.id, m.id, m.author_id, m.author_name, m.content, report.reporter,
+             report.broadCategory, report.specificCategory, report.optionalMessage, report.postVisibility,
+             report.userVisibility, report.confidence, report.created)))
+
+    def close_report(self, report, decision):
+        self.writes.put(("UPDATE reports SET status = 'closed', decision = ?, closed = ? WHERE id = ?",
+                         (decision, time.time(), report.id)))
+
+    def increment_karma(self, user_id):
+        self.writes.put(('INSERT INTO karma (user_id, count) VALUES (?, 1) ON CONFLICT (user_id) DO UPDATE SET count = count + 1',
+                         (user_id,)))
+
+    def load_karma(self):
+        with closing(self.connect()) as conn:
+            return dict(conn.execute('SELECT user_id, count FROM karma'))
+
+    def load_pending(self):
+        '''
+        Returns the pending reports as dicts, oldest first, and the highest report id ever handed out.
+        '''
+        with closing(self.connect()) as conn:
+            conn.row_factory = sqlite3.Row
+            rows = [dict(row) for row in conn.execute("SELECT * FROM reports WHERE status = 'pending' ORDER BY id")]
+            last_id = conn.execute('SELECT MAX(id) FROM reports').fetchone()[0] or 0
+        return rows, last_id
+
+    def close(self):
+        # Flush everything still queued before returning
+        self.writes.put(None)
+        self.writer.join()